@@ -82,12 +82,16 @@ try:
     db_name = connection.creation.create_test_db(verbosity=verbosity, autoclobber=not interactive)
     call_command('loaddata', *fixtures, **{'verbosity': verbosity})
 
-    from tests.bench import TESTS  # import is here because it executes queries
-    if selector:
-        tests = [(name, test) for name, test in TESTS if select(name)]
+    if 'm' in flags:
+        from tests.bench_memory import run_memory_benchmarks
+        run_memory_benchmarks()
     else:
-        tests = TESTS
-    run_benchmarks(tests)
+        from tests.bench import TESTS  # import is here because it executes queries
+        if selector:
+            tests = [(name, test) for name, test in TESTS if select(name)]
+        else:
+            tests = TESTS
+        run_benchmarks(tests)
 except KeyboardInterrupt:
     pass
 finally:
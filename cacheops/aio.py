@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+"""
+Asyncio counterparts of cacheops caching and invalidation.
+
+Built on top of redis.asyncio client with its own connection pool,
+so this requires Python 3.7+ and redis-py 4.2+.
+"""
+import json
+import time
+import warnings
+from contextlib import asynccontextmanager
+from functools import wraps
+
+import redis
+from redis import asyncio as aioredis
+from redis.asyncio.sentinel import Sentinel
+from funcy import memoize, omit, select_keys, LazyObject
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS
+
+from .conf import settings
+from .sharding import get_prefix
+from .redis import LOCK_TIMEOUT, read_script
+from .utils import func_cache_key, family_has_local_get
+from .query import CachedAs, pack_thing
+from .simple import CacheMiss, RedisCache
+from .serializers import early_beta
+from .local import local_cache, local_get_cache, LOCAL_GET_CHANNEL, ALL_TABLES
+from .invalidation import no_invalidation, get_obj_dict, generation_key, globs_re, \
+                         split_matched, INVALIDATE_CHUNK
+from .transaction import transaction_states
+from .signals import cache_read, cache_invalidated
+
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:
+    sync_to_async = None
+
+
+__all__ = ('acached_as', 'acached', 'afetch', 'ainvalidate_dict', 'ainvalidate_obj',
+           'ainvalidate_model', 'ainvalidate_all', 'aredis_client')
+
+
+if settings.CACHEOPS_DEGRADE_ON_FAILURE:
+    def handle_connection_failure(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            try:
+                return await func(*args, **kwargs)
+            except redis.ConnectionError as e:
+                warnings.warn("The cacheops cache is unreachable! Error: %s" % e, RuntimeWarning)
+            except redis.TimeoutError as e:
+                warnings.warn("The cacheops cache timed out! Error: %s" % e, RuntimeWarning)
+        return wrapper
+else:
+    handle_connection_failure = lambda func: func
+
+
+async def run_sync(func, *args):
+    """
+    Runs sync code, e.g. database queries, in a thread if asgiref is available.
+    """
+    if sync_to_async is None:
+        return func(*args)
+    return await sync_to_async(func)(*args)
+
+
+class AsyncCacheopsRedis(aioredis.StrictRedis):
+    get = handle_connection_failure(aioredis.StrictRedis.get)
+    mget = handle_connection_failure(aioredis.StrictRedis.mget)
+
+    @asynccontextmanager
+    async def getting(self, key, lock=False, stale=0, stale_on_invalidation=False):
+        """
+        Same as CacheopsRedis.getting(), but to be used with async with.
+        """
+        if stale:
+            data = await self.get(key)
+            # Key is locked while someone calculates it, see _get_or_lock()
+            calculating = data == b'LOCK'
+            if data is None or calculating:
+                data = await self._get_stale(key, stale_on_invalidation, refresh=not calculating)
+            if data == 1:
+                # We are to refresh stale data
+                yield None
+                return
+            elif data is not None:
+                yield data
+                return
+
+        if not lock:
+            yield await self.get(key)
+        else:
+            locked = False
+            try:
+                data = await self._get_or_lock(key)
+                locked = data is None
+                yield data
+            finally:
+                if locked:
+                    await self._release_lock(key)
+
+    @handle_connection_failure
+    async def _get_or_lock(self, key):
+        signal_key = key + ':signal'
+
+        while True:
+            data = await self.get(key)
+            if data is None:
+                if await aload_script('lock')(keys=[key, signal_key], args=[LOCK_TIMEOUT],
+                                              client=self):
+                    return None
+            elif data != b'LOCK':
+                return data
+
+            # No data and not locked, wait
+            await self.brpoplpush(signal_key, signal_key, timeout=LOCK_TIMEOUT)
+
+    @handle_connection_failure
+    async def _get_stale(self, key, on_invalidation, refresh=True):
+        return await aload_script('get_stale')(
+            keys=[key + ':stale', key + ':invalidated'],
+            args=[int(on_invalidation), LOCK_TIMEOUT, int(refresh)], client=self)
+
+    @handle_connection_failure
+    async def _release_lock(self, key):
+        signal_key = key + ':signal'
+        await aload_script('unlock')(keys=[key, signal_key], client=self)
+
+
+@LazyObject
+def aredis_client():
+    if settings.CACHEOPS_REDIS and settings.CACHEOPS_SENTINEL:
+        raise ImproperlyConfigured("CACHEOPS_REDIS and CACHEOPS_SENTINEL are mutually exclusive")
+
+    if settings.CACHEOPS_SENTINEL:
+        if not {'locations', 'service_name'} <= set(settings.CACHEOPS_SENTINEL):
+            raise ImproperlyConfigured("Specify locations and service_name for CACHEOPS_SENTINEL")
+
+        sentinel = Sentinel(
+            settings.CACHEOPS_SENTINEL['locations'],
+            **omit(settings.CACHEOPS_SENTINEL, ('locations', 'service_name', 'db')))
+        return sentinel.master_for(
+            settings.CACHEOPS_SENTINEL['service_name'],
+            redis_class=AsyncCacheopsRedis,
+            db=settings.CACHEOPS_SENTINEL.get('db', 0)
+        )
+
+    # Allow client connection settings to be specified by a URL.
+    if isinstance(settings.CACHEOPS_REDIS, str):
+        return AsyncCacheopsRedis.from_url(settings.CACHEOPS_REDIS)
+    else:
+        return AsyncCacheopsRedis(**settings.CACHEOPS_REDIS)
+
+
+@memoize
+def aload_script(name, strip=False):
+    return aredis_client.register_script(read_script(name, strip))
+
+
+_can_unlink = []
+
+async def aredis_can_unlink():
+    if not _can_unlink:
+        info = await aredis_client.info()
+        _can_unlink.append(tuple(map(int, info['redis_version'].split('.')[:2])) >= (4, 0))
+    return _can_unlink[0]
+
+
+### Caching
+
+@handle_connection_failure
+async def acache_thing(prefix, cache_key, data, cond_dnfs, timeout, dbs=(), precall_key='',
+                       **kwargs):
+    """
+    Same as cache_thing(), but async.
+    """
+    if transaction_states.is_dirty(dbs):
+        return
+    keys, args = pack_thing(prefix, cache_key, data, cond_dnfs, timeout, precall_key, **kwargs)
+    await aload_script('cache_thing', settings.CACHEOPS_LRU)(keys=keys, args=args)
+
+
+async def afetch(queryset):
+    """
+    Evaluates a queryset looking up its cache asynchronously, returns a list of results.
+    The database is only queried on a miss, in a thread if asgiref is available.
+    """
+    qs = queryset
+    if qs._result_cache is None and qs._should_cache('fetch'):
+        profile = qs._cacheprofile
+        gens = None
+        if settings.CACHEOPS_GENERATIONS:
+            gens = await aget_generations(qs._prefix, qs._cond_dnfs)
+        cache_key = qs._cache_key(gens=gens)
+        options = select_keys({'lock', 'stale', 'stale_on_invalidation'}, profile)
+        async with aredis_client.getting(cache_key, **options) as cache_data:
+            if cache_data is not None and qs._expires_early(cache_data):
+                cache_data = None
+            cache_read.send(sender=qs.model, func=None, hit=cache_data is not None)
+            if cache_data is not None:
+                qs._result_cache = qs._load_results(cache_data)
+            else:
+                start = time.time()
+                qs._result_cache = await run_sync(qs._fetch_results)
+                await acache_thing(qs._prefix, cache_key, qs._result_cache,
+                                   qs._cond_dnfs, profile['timeout'], dbs=[qs.db],
+                                   **qs._thing_options(time.time() - start))
+
+    # Fetch uncached ones and do prefetch_related() if needed
+    if qs._result_cache is None or qs._prefetch_related_lookups and not qs._prefetch_done:
+        await run_sync(qs._fetch_all)
+    return qs._result_cache
+
+
+def acached_as(*samples, **kwargs):
+    """
+    Same as cached_as(), but for async functions.
+    NOTE: coalesce and local_cache options are not supported.
+    """
+    params = CachedAs(samples, kwargs)
+    if params.noop:
+        return lambda func: func
+
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not params.enabled():
+                return await func(*args, **kwargs)
+
+            gens = None
+            if settings.CACHEOPS_GENERATIONS:
+                gens = await aget_generations(params.prefix(func), params.cond_dnfs)
+            prefix, cache_key = params.cache_key(func, args, kwargs, gens=gens)
+
+            async with aredis_client.getting(cache_key, **params.getting_options()) as cache_data:
+                if cache_data is not None and params.expires_early(cache_data):
+                    cache_data = None
+                cache_read.send(sender=None, func=func, hit=cache_data is not None)
+                if cache_data is not None:
+                    return params.load(cache_data)
+
+                precall_key = params.precall_key(prefix, func, args, kwargs)
+                if precall_key:
+                    await acache_thing(prefix, precall_key, 'PRECALL', params.cond_dnfs,
+                                       params.timeout, dbs=params.dbs)
+
+                start = time.time()
+                result = await func(*args, **kwargs)
+                await acache_thing(prefix, cache_key, result, params.cond_dnfs, params.timeout,
+                                   precall_key=precall_key,
+                                   **params.thing_options(time.time() - start))
+                return result
+
+        return wrapper
+    return decorator
+
+
+def acached(timeout=None, extra=None, key_func=func_cache_key, early=False, jitter=0):
+    """
+    Same as cached(), but for async functions.
+    """
+    # Support @acached (without parentheses) form
+    if callable(timeout):
+        return acached(key_func=key_func)(timeout)
+    beta = early_beta(early)
+
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not settings.CACHEOPS_ENABLED:
+                return await func(*args, **kwargs)
+
+            cache_key = 'c:' + key_func(func, args, kwargs, extra)
+            try:
+                return RedisCache.unpack(await aredis_client.get(cache_key), beta)
+            except CacheMiss:
+                start = time.time()
+                result = await func(*args, **kwargs)
+                compute_time = time.time() - start if beta else None
+                await _set(cache_key, result, timeout, compute_time, jitter)
+                return result
+
+        async def invalidate(*args, **kwargs):
+            cache_key = 'c:' + key_func(func, args, kwargs, extra)
+            await _delete(cache_key)
+        wrapper.invalidate = invalidate
+
+        return wrapper
+    return decorator
+
+
+@handle_connection_failure
+async def _set(cache_key, data, timeout, compute_time, jitter):
+    data, timeout = RedisCache.pack(data, timeout, compute_time, jitter)
+    if timeout is not None:
+        await aredis_client.setex(cache_key, timeout, data)
+    else:
+        await aredis_client.set(cache_key, data)
+
+
+@handle_connection_failure
+async def _delete(cache_key):
+    await aredis_client.delete(cache_key)
+
+
+### Invalidation
+# NOTE: unlike sync versions these are not postponed till transaction commit,
+#       since database is not accessed from async code directly.
+
+@handle_connection_failure
+async def ainvalidate_dict(model, obj_dict, using=DEFAULT_DB_ALIAS):
+    if no_invalidation.active or not settings.CACHEOPS_ENABLED:
+        return
+    model = model._meta.concrete_model
+    db_table = model._meta.db_table
+    prefix = get_prefix(_cond_dnfs=[(db_table, list(obj_dict.items()))], dbs=[using])
+    patterns, deferred, _ = await aload_script('invalidate', strip=await aredis_can_unlink())(
+        keys=[prefix],
+        args=[db_table, json.dumps([obj_dict], default=str), '',
+              settings.CACHEOPS_INVALIDATE_BUDGET or '', int(settings.CACHEOPS_COMPACT_KEYS)]
+    )
+    # Dicts lacking some fields match conj keys by patterns, see invalidate_dicts()
+    if patterns:
+        await _ainvalidate_conjs(prefix, db_table, patterns=patterns)
+    for conj_key in deferred:
+        await _ainvalidate_conj_members(prefix, db_table, conj_key)
+    if family_has_local_get(model):
+        await _drop_local_get(model._meta.db_table)
+    cache_invalidated.send(sender=model, obj_dict=obj_dict)
+
+
+async def ainvalidate_obj(obj, using=DEFAULT_DB_ALIAS):
+    """
+    Invalidates caches that can possibly be influenced by object
+    """
+    model = obj.__class__._meta.concrete_model
+    await ainvalidate_dict(model, get_obj_dict(model, obj), using=using)
+
+
+@handle_connection_failure
+async def ainvalidate_model(model, using=DEFAULT_DB_ALIAS):
+    """
+    Invalidates all caches for given model.
+    """
+    if no_invalidation.active or not settings.CACHEOPS_ENABLED:
+        return
+    model = model._meta.concrete_model
+    prefix = get_prefix(tables=[model._meta.db_table], dbs=[using])
+    if settings.CACHEOPS_GENERATIONS:
+        await aredis_client.incr(generation_key(prefix, model._meta.db_table))
+    else:
+        await _ainvalidate_conjs(prefix, model._meta.db_table)
+    if family_has_local_get(model):
+        await _drop_local_get(model._meta.db_table)
+    cache_invalidated.send(sender=model, obj_dict=None)
+
+
+async def _ainvalidate_conjs(prefix, db_table, patterns=None):
+    conjs_key = '%sconjs:%s' % (prefix, db_table)
+    script = aload_script('invalidate_conjs', strip=await aredis_can_unlink())
+    matcher = globs_re(patterns) if patterns is not None else None
+
+    async def invalidate_chunk(chunk):
+        matched, rest = split_matched(matcher, chunk)
+        if matched:
+            await script(keys=[conjs_key], args=matched)
+        if rest:
+            await aload_script('prune_conjs')(keys=[conjs_key], args=rest)
+
+    chunk = []
+    async for conj_key in aredis_client.sscan_iter(conjs_key, count=INVALIDATE_CHUNK):
+        chunk.append(conj_key)
+        if len(chunk) >= INVALIDATE_CHUNK:
+            await invalidate_chunk(chunk)
+            chunk = []
+    if chunk:
+        await invalidate_chunk(chunk)
+
+
+async def _ainvalidate_conj_members(prefix, db_table, conj_key):
+    conjs_key = '%sconjs:%s' % (prefix, db_table)
+    script = aload_script('invalidate_members', strip=await aredis_can_unlink())
+
+    chunk = []
+    async for member in aredis_client.sscan_iter(conj_key, count=INVALIDATE_CHUNK):
+        chunk.append(member)
+        if len(chunk) >= INVALIDATE_CHUNK:
+            await script(keys=[conj_key, conjs_key], args=[''] + chunk)
+            chunk = []
+    if chunk:
+        await script(keys=[conj_key, conjs_key], args=[''] + chunk)
+
+
+@handle_connection_failure
+async def ainvalidate_all():
+    if no_invalidation.active or not settings.CACHEOPS_ENABLED:
+        return
+    await aredis_client.flushdb()
+    local_cache.clear()
+    await _drop_local_get(ALL_TABLES)
+    cache_invalidated.send(sender=None, obj_dict=None)
+
+
+async def aget_generations(prefix, tables):
+    """
+    Same as get_generations(), but async.
+    """
+    tables = sorted(set(tables))
+    gens = await aredis_client.mget([generation_key(prefix, t) for t in tables])
+    return {table: int(gen or 0) for table, gen in zip(tables, gens or [None] * len(tables))}
+
+
+async def _drop_local_get(db_table):
+    local_get_cache.drop_table(db_table)
+    await aredis_client.publish(LOCAL_GET_CHANNEL, db_table)
@@ -8,6 +8,8 @@ from django.core.signals import setting_changed
 from django.db import models
 from django.utils.module_loading import import_string
 
+from .serializers import get_serializer, compress_level, early_beta
+
 
 ALL_OPS = {'get', 'fetch', 'count', 'aggregate', 'exists'}
 
@@ -21,11 +23,20 @@ class Defaults(namespace):
     CACHEOPS_LRU = False
     CACHEOPS_CLIENT_CLASS = None
     CACHEOPS_DEGRADE_ON_FAILURE = False
+    CACHEOPS_GENERATIONS = False
+    CACHEOPS_SNAPSHOT = False
+    CACHEOPS_INVALIDATE_BUDGET = 10000
+    CACHEOPS_COMPACT_KEYS = False
     CACHEOPS_SENTINEL = {}
     # NOTE: we don't use this fields in invalidator conditions since their values could be very long
     #       and one should not filter by their equality anyway.
     CACHEOPS_SKIP_FIELDS = models.FileField, models.TextField, models.BinaryField
     CACHEOPS_LONG_DISJUNCTION = 8
+    CACHEOPS_LOCAL_CACHE_SIZE = 1000
+    CACHEOPS_LOCAL_GET_SIZE = 10000
+    CACHEOPS_SERIALIZER = 'pickle'
+    CACHEOPS_COMPRESS = False
+    CACHEOPS_COMPRESS_MIN_SIZE = 1024
 
     FILE_CACHE_DIR = '/tmp/cacheops_file_cache'
     FILE_CACHE_TIMEOUT = 60*60*24*30
@@ -54,6 +65,17 @@ def prepare_profiles():
         'local_get': False,
         'db_agnostic': True,
         'lock': False,
+        'coalesce': False,
+        'local_cache': False,
+        'serializer': settings.CACHEOPS_SERIALIZER,
+        'compress': settings.CACHEOPS_COMPRESS,
+        'compress_min_size': settings.CACHEOPS_COMPRESS_MIN_SIZE,
+        'stale': 0,
+        'stale_on_invalidation': False,
+        'early': False,
+        'jitter': 0,
+        'ignore_fields': (),
+        'invalidate_updates': False,
     }
     profile_defaults.update(settings.CACHEOPS_DEFAULTS)
 
@@ -70,6 +92,9 @@ def prepare_profiles():
         if isinstance(mp['ops'], six.string_types):
             mp['ops'] = {mp['ops']}
         mp['ops'] = set(mp['ops'])
+        mp['serializer'] = get_serializer(mp['serializer'])
+        mp['compress'] = compress_level(mp['compress'])
+        mp['early'] = early_beta(mp['early'])
 
         if 'timeout' not in mp:
             raise ImproperlyConfigured(
@@ -19,6 +19,9 @@ else:
         def update(self, s):
             return self.md5.update(s.encode('utf-8'))
 
+        def digest(self):
+            return self.md5.digest()
+
         def hexdigest(self):
             return self.md5.hexdigest()
 
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
+import re
 import json
 import threading
-from funcy import memoize, post_processing, ContextDecorator
+from collections import defaultdict
+from funcy import memoize, post_processing, ContextDecorator, group_by, distinct, chunks
 from django.db import DEFAULT_DB_ALIAS
 from django.db.models.expressions import F, Expression
 from distutils.version import StrictVersion
@@ -9,11 +11,18 @@ from distutils.version import StrictVersion
 from .conf import settings
 from .sharding import get_prefix
 from .redis import redis_client, handle_connection_failure, load_script
+from .utils import family_has_local_get
+from .local import local_cache, drop_local_get, ALL_TABLES
 from .signals import cache_invalidated
 from .transaction import queue_when_in_transaction
 
 
-__all__ = ('invalidate_obj', 'invalidate_model', 'invalidate_all', 'no_invalidation')
+__all__ = ('invalidate_obj', 'invalidate_objs', 'invalidate_model', 'invalidate_all',
+           'no_invalidation', 'postpone_invalidation')
+
+
+# How many conj keys or members to process at a time in chunked invalidation
+INVALIDATE_CHUNK = 1000
 
 
 @memoize
@@ -22,25 +31,54 @@ def redis_can_unlink():
     return StrictVersion(redis_version) >= StrictVersion('4.0')
 
 
-def invalidate_keys(*keys):
-    if redis_can_unlink():
-        redis_client.execute_command('UNLINK', *keys)
-    else:
-        redis_client.delete(*keys)
+def invalidate_dict(model, obj_dict, using=DEFAULT_DB_ALIAS):
+    invalidate_dicts(model, [obj_dict], using=using)
+
+
+def invalidate_dicts(model, obj_dicts, using=DEFAULT_DB_ALIAS, changed_fields=None):
+    """
+    Invalidates caches for several dicts of the same model at once,
+    makes a single script call unless they are sharded to different prefixes.
+
+    Passing changed_fields spares caches known not to depend on any of them.
+    """
+    # Collect postponed ones before they are queued till transaction commit,
+    # so that they are batched there too
+    if postpone_invalidation.active and not no_invalidation.active:
+        if settings.CACHEOPS_ENABLED and obj_dicts:
+            # NOTE: we don't keep changed fields here, so these will be invalidated fully
+            postpone_invalidation.add_dicts(model._meta.concrete_model, obj_dicts, using)
+        return
+    _invalidate_dicts(model, obj_dicts, using=using, changed_fields=changed_fields)
 
 
 @queue_when_in_transaction
 @handle_connection_failure
-def invalidate_dict(model, obj_dict, using=DEFAULT_DB_ALIAS):
-    if no_invalidation.active or not settings.CACHEOPS_ENABLED:
+def _invalidate_dicts(model, obj_dicts, using=DEFAULT_DB_ALIAS, changed_fields=None):
+    if no_invalidation.active or not settings.CACHEOPS_ENABLED or not obj_dicts:
         return
     model = model._meta.concrete_model
-    prefix = get_prefix(_cond_dnfs=[(model._meta.db_table, list(obj_dict.items()))], dbs=[using])
-    load_script('invalidate', strip=redis_can_unlink())(keys=[prefix], args=[
-        model._meta.db_table,
-        json.dumps(obj_dict, default=str)
-    ])
-    cache_invalidated.send(sender=model, obj_dict=obj_dict)
+    db_table = model._meta.db_table
+    changed = json.dumps(sorted(changed_fields)) if changed_fields is not None else ''
+    obj_dicts = list(distinct(obj_dicts, key=_dict_key))
+    by_prefix = group_by(
+        lambda d: get_prefix(_cond_dnfs=[(db_table, list(d.items()))], dbs=[using]), obj_dicts)
+    budget = settings.CACHEOPS_INVALIDATE_BUDGET or ''
+    compact = int(settings.CACHEOPS_COMPACT_KEYS)
+    for prefix, prefix_dicts in by_prefix.items():
+        patterns, deferred, members_changed = load_script('invalidate', strip=redis_can_unlink())(
+            keys=[prefix],
+            args=[db_table, json.dumps(prefix_dicts, default=str), changed, budget, compact]
+        )
+        # Dicts lacking some fields match conj keys by patterns, see invalidate_conds()
+        if patterns:
+            _invalidate_conjs(prefix, db_table, patterns=patterns)
+        for conj_key in deferred:
+            _invalidate_conj_members(prefix, db_table, conj_key, members_changed)
+    if family_has_local_get(model):
+        drop_local_get(db_table)
+    for obj_dict in obj_dicts:
+        cache_invalidated.send(sender=model, obj_dict=obj_dict)
 
 
 def invalidate_obj(obj, using=DEFAULT_DB_ALIAS):
@@ -51,33 +89,231 @@ def invalidate_obj(obj, using=DEFAULT_DB_ALIAS):
     invalidate_dict(model, get_obj_dict(model, obj), using=using)
 
 
-@queue_when_in_transaction
-@handle_connection_failure
+def invalidate_objs(objs, using=DEFAULT_DB_ALIAS, changed_fields=None):
+    """
+    Invalidates caches that can possibly be influenced by any of objects,
+    with a single script call per model.
+    """
+    by_model = group_by(lambda obj: obj.__class__._meta.concrete_model, objs)
+    for model, model_objs in by_model.items():
+        invalidate_dicts(model, [get_obj_dict(model, obj) for obj in model_objs], using=using,
+                         changed_fields=changed_fields)
+
+
 def invalidate_model(model, using=DEFAULT_DB_ALIAS):
     """
     Invalidates all caches for given model.
-    NOTE: This is a heavy artillery which uses redis KEYS request,
-          which could be relatively slow on large datasets.
+    Goes through a registry of conj keys of the model table in chunks,
+    so it doesn't block redis for long even on large datasets.
+    With CACHEOPS_GENERATIONS on this is a single INCR of table generation.
     """
+    if postpone_invalidation.active and not no_invalidation.active:
+        if settings.CACHEOPS_ENABLED:
+            postpone_invalidation.add_model(model._meta.concrete_model, using)
+        return
+    _invalidate_model(model, using=using)
+
+
+@queue_when_in_transaction
+@handle_connection_failure
+def _invalidate_model(model, using=DEFAULT_DB_ALIAS):
     if no_invalidation.active or not settings.CACHEOPS_ENABLED:
         return
     model = model._meta.concrete_model
     # NOTE: if we use sharding dependent on DNF then this will fail,
     #       which is ok, since it's hard/impossible to predict all the shards
     prefix = get_prefix(tables=[model._meta.db_table], dbs=[using])
-    conjs_keys = redis_client.keys('%sconj:%s:*' % (prefix, model._meta.db_table))
-    if conjs_keys:
-        cache_keys = redis_client.sunion(conjs_keys)
-        keys = list(cache_keys) + conjs_keys
-        invalidate_keys(*keys)
+    if settings.CACHEOPS_GENERATIONS:
+        # Old keys are orphaned by this and will just expire
+        redis_client.incr(generation_key(prefix, model._meta.db_table))
+    else:
+        _invalidate_conjs(prefix, model._meta.db_table)
+    if family_has_local_get(model):
+        drop_local_get(model._meta.db_table)
     cache_invalidated.send(sender=model, obj_dict=None)
 
 
+def _invalidate_conjs(prefix, db_table, patterns=None):
+    """
+    Invalidates conj keys in table registry, all of them or ones matching any of glob patterns.
+    Patterns are matched here, so that registry is walked once however many of them are there.
+    Expired conj keys not matching are pruned from registry along the way.
+    """
+    conjs_key = '%sconjs:%s' % (prefix, db_table)
+    script = load_script('invalidate_conjs', strip=redis_can_unlink())
+    matcher = globs_re(patterns) if patterns is not None else None
+    conj_keys = redis_client.sscan_iter(conjs_key, count=INVALIDATE_CHUNK)
+    for chunk in chunks(INVALIDATE_CHUNK, conj_keys):
+        matched, rest = split_matched(matcher, chunk)
+        if matched:
+            script(keys=[conjs_key], args=matched)
+        if rest:
+            load_script('prune_conjs')(keys=[conjs_key], args=rest)
+
+
+def split_matched(matcher, conj_keys):
+    """
+    Splits conj keys into ones matching regex and the rest, all match no regex.
+    """
+    if matcher is None:
+        return conj_keys, []
+    matched = [key for key in conj_keys if matcher.match(key)]
+    return matched, [key for key in conj_keys if not matcher.match(key)]
+
+
+def _invalidate_conj_members(prefix, db_table, conj_key, changed=''):
+    """
+    Goes through a conj key too big to be invalidated by a single script call in chunks.
+    """
+    conjs_key = '%sconjs:%s' % (prefix, db_table)
+    script = load_script('invalidate_members', strip=redis_can_unlink())
+    members = redis_client.sscan_iter(conj_key, count=INVALIDATE_CHUNK)
+    for chunk in chunks(INVALIDATE_CHUNK, members):
+        script(keys=[conj_key, conjs_key], args=[changed] + chunk)
+
+
+def globs_re(patterns):
+    """
+    Compiles redis glob patterns as made by invalidate.lua into a single regex,
+    only * is a wildcard there, other special chars are escaped with backslash.
+    """
+    def translate(pattern):
+        parts = re.split(br'(\\.|\*)', pattern, flags=re.S)
+        return b''.join(b'.*' if part == b'*' else
+                        re.escape(part[1:] if part.startswith(b'\\') else part)
+                        for part in parts)
+    return re.compile(b'(?:' + b'|'.join(map(translate, patterns)) + b')$', re.S)
+
+
+def invalidate_conds(model, conds, using=DEFAULT_DB_ALIAS, changed_fields=None):
+    """
+    Invalidates caches that can possibly be influenced by any object matching conds,
+    which are dicts of field values same as object dicts, but lacking some fields.
+    Conj keys with any value of those are looked up in a registry,
+    empty conds match everything and so invalidate the whole model.
+    """
+    if not conds or not all(conds):
+        invalidate_model(model, using=using)
+    else:
+        invalidate_dicts(model, conds, using=using, changed_fields=changed_fields)
+
+
+### Table generations
+
+def generation_key(prefix, db_table):
+    return '%sgen:%s' % (prefix, db_table)
+
+
+def get_generations(prefix, tables):
+    """
+    Returns a dict of current generations for tables,
+    these are mixed into cache keys when CACHEOPS_GENERATIONS is on.
+    """
+    tables = sorted(set(tables))
+    gens = redis_client.mget([generation_key(prefix, t) for t in tables]) or [None] * len(tables)
+    return {table: int(gen or 0) for table, gen in zip(tables, gens)}
+
+
+### Schemes maintenance
+
+def reap_schemes(model, using=DEFAULT_DB_ALIAS):
+    """
+    Drops schemes of model table no live conj keys use anymore,
+    so that invalidation doesn't try them, and returns them.
+    Prunes expired or evicted conj keys from table registry along the way.
+
+    NOTE: conj keys are looked up in the whole keyspace, since those written by older versions
+          are not in registry, and never expire with CACHEOPS_LRU.
+    """
+    db_table = model._meta.concrete_model._meta.db_table
+    prefix = get_prefix(tables=[db_table], dbs=[using])
+    schemes_key = '%sschemes:%s' % (prefix, db_table)
+    reap_key = '%sschemes_reap:%s' % (prefix, db_table)
+    conjs_key = '%sconjs:%s' % (prefix, db_table)
+
+    # Schemes used from now on are removed from candidates by cache_thing.lua,
+    # so that we won't drop any of them whatever we see in registry
+    redis_client.sunionstore(reap_key, schemes_key)
+    key_prefix = _conj_key_prefix(prefix, db_table)
+    matchers = {scheme: _scheme_re(key_prefix, scheme)
+                for scheme in redis_client.smembers(reap_key)}
+
+    prune = load_script('prune_conjs')
+    conj_keys = redis_client.sscan_iter(conjs_key, count=INVALIDATE_CHUNK)
+    for chunk in chunks(INVALIDATE_CHUNK, conj_keys):
+        prune(keys=[conjs_key], args=chunk)
+
+    live = set()
+    for conj_key in _scan_conj_keys(key_prefix):
+        live.update(scheme for scheme, matcher in matchers.items()
+                    if scheme not in live and matcher.match(conj_key))
+    return load_script('reap_schemes')(keys=[schemes_key, reap_key], args=list(live))
+
+
+def merge_schemes(model, using=DEFAULT_DB_ALIAS):
+    """
+    Drops schemes of model table with fields not in canonical order, as written by older
+    versions, and returns them. Their conj keys are invalidated, so that caches are rewritten
+    under canonical ones, which merges any duplicate schemes of the same fields.
+    """
+    db_table = model._meta.concrete_model._meta.db_table
+    prefix = get_prefix(tables=[db_table], dbs=[using])
+    schemes_key = '%sschemes:%s' % (prefix, db_table)
+    conjs_key = '%sconjs:%s' % (prefix, db_table)
+
+    legacy = [scheme for scheme in redis_client.smembers(schemes_key)
+              if scheme != b','.join(sorted(scheme.split(b',')))]
+    if not legacy:
+        return []
+    key_prefix = _conj_key_prefix(prefix, db_table)
+    matchers = [_scheme_re(key_prefix, scheme) for scheme in legacy]
+
+    # Older versions didn't register conj keys, so we look for them in the whole keyspace.
+    # Schemes are only dropped after that, otherwise their caches would never be invalidated.
+    script = load_script('invalidate_conjs', strip=redis_can_unlink())
+    conj_keys = _scan_conj_keys(key_prefix)
+    legacy_keys = (key for key in conj_keys if any(m.match(key) for m in matchers))
+    for chunk in chunks(INVALIDATE_CHUNK, legacy_keys):
+        script(keys=[conjs_key], args=chunk)
+    redis_client.srem(schemes_key, *legacy)
+    return legacy
+
+
+def _scheme_re(key_prefix, scheme):
+    # NOTE: values may contain anything, so this could match some conj keys of other schemes,
+    #       which only leaves a dead scheme, but never drops a live one.
+    fields = scheme.split(b',') if scheme else []
+    conj = b'&'.join(re.escape(field) + b'=.*' for field in fields)
+    return re.compile(re.escape(key_prefix) + conj + b'$', re.S)
+
+
+def _scan_conj_keys(key_prefix):
+    """
+    Walks conj keys starting with key_prefix with non-blocking SCAN,
+    this finds ones missing from table registry too.
+    """
+    match = re.sub(br'[*?\[\]\\]', br'\\\g<0>', key_prefix) + b'*'
+    return redis_client.scan_iter(match=match, count=INVALIDATE_CHUNK)
+
+
+def _conj_key_prefix(prefix, db_table):
+    if settings.CACHEOPS_COMPACT_KEYS:
+        # Table is referred by id, see cache_thing.lua
+        table_id = redis_client.hget(prefix + 'ids', db_table) or b''
+        return prefix.encode('utf-8') + b'j:' + table_id + b':'
+    return ('%sconj:%s:' % (prefix, db_table)).encode('utf-8')
+
+
 @handle_connection_failure
 def invalidate_all():
     if no_invalidation.active or not settings.CACHEOPS_ENABLED:
         return
+    if postpone_invalidation.active:
+        postpone_invalidation.add_all()
+        return
     redis_client.flushdb()
+    local_cache.clear()
+    drop_local_get(ALL_TABLES)
     cache_invalidated.send(sender=None, obj_dict=None)
 
 
@@ -101,6 +337,69 @@ class _no_invalidation(ContextDecorator):
 no_invalidation = _no_invalidation()
 
 
+class PostponedState(threading.local):
+    def __init__(self):
+        self.depth = 0
+        self.reset()
+
+    def reset(self):
+        self.all = False
+        self.models = set()
+        self.dicts = defaultdict(dict)
+
+class _postpone_invalidation(ContextDecorator):
+    """
+    Collects invalidations and runs them in batches on exit,
+    each distinct object dict is only invalidated once.
+    """
+    state = PostponedState()
+
+    def __enter__(self):
+        self.state.depth += 1
+
+    def __exit__(self, type, value, traceback):
+        self.state.depth -= 1
+        # Changes could have been written even if we are exiting on exception
+        if not self.state.depth:
+            self.flush()
+
+    @property
+    def active(self):
+        return self.state.depth
+
+    def add_dicts(self, model, obj_dicts, using):
+        dicts = self.state.dicts[model, using]
+        for obj_dict in obj_dicts:
+            dicts[_dict_key(obj_dict)] = obj_dict
+
+    def add_model(self, model, using):
+        self.state.models.add((model, using))
+
+    def add_all(self):
+        self.state.all = True
+
+    def flush(self):
+        state = self.state
+        everything, models, dicts = state.all, state.models, state.dicts
+        state.reset()
+
+        if everything:
+            invalidate_all()
+            return
+        for model, using in models:
+            invalidate_model(model, using=using)
+        for (model, using), obj_dicts in dicts.items():
+            # Already invalidated as a whole
+            if (model, using) not in models:
+                invalidate_dicts(model, list(obj_dicts.values()), using=using)
+
+postpone_invalidation = _postpone_invalidation()
+
+
+def _dict_key(obj_dict):
+    return json.dumps(obj_dict, sort_keys=True, default=str)
+
+
 ### ORM instance serialization
 
 @memoize
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+import os, time
+import threading
+from collections import OrderedDict
+
+import redis
+from django.utils.encoding import force_text
+
+from .conf import settings
+from .redis import redis_client, handle_connection_failure, load_script
+from .simple import CacheMiss
+
+
+__all__ = ('local_cache', 'local_get_cache', 'LRUCache', 'LocalCache', 'LocalGetCache')
+
+
+### Version stamps
+
+VERSION_MARK = b'\x00'
+VERSION_LEN = 9
+
+def stamp_version(data):
+    """
+    Prepends a random version stamp to serialized data.
+    Pickles start with other byte so stamped and plain data could coexist.
+    """
+    return VERSION_MARK + os.urandom(VERSION_LEN - 1) + data
+
+def get_version(data):
+    return data[:VERSION_LEN] if data[:1] == VERSION_MARK else None
+
+def strip_version(data):
+    return data[VERSION_LEN:] if data[:1] == VERSION_MARK else data
+
+
+### Local caches
+
+class LRUCache(object):
+    """
+    A thread-safe dict-like cache evicting least recently used items over size.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            if len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+@handle_connection_failure
+def _get_if_changed(key, version):
+    return load_script('get_if_changed')(keys=[key], args=[version or b''])
+
+
+class LocalCache(LRUCache):
+    """
+    In-process first level cache of redis data.
+
+    Each entry remembers the version of data, so it is validated with a tiny version check
+    instead of transferring data. Within window seconds since last check an entry is trusted
+    without asking redis at all. Data is loaded on every hit, so that callers won't share
+    and mutate the same objects.
+    """
+    def lookup(self, key, window, load):
+        entry = self.get(key)
+        now = time.time()
+        if entry is not None:
+            version, data, checked = entry
+            if now - checked < window:
+                return load(data)
+        else:
+            version = None
+
+        fresh_data = _get_if_changed(key, version)
+        if fresh_data == 1:
+            self[key] = version, data, now
+            return load(data)
+        elif fresh_data is None:
+            self.pop(key)
+            raise CacheMiss
+
+        data = fresh_data
+        version = get_version(data)
+        if version:
+            self[key] = version, data, now
+        else:
+            self.pop(key)
+        return load(data)
+
+local_cache = LocalCache(settings.CACHEOPS_LOCAL_CACHE_SIZE)
+
+
+def local_window(option):
+    """
+    Converts local_cache option to staleness window in seconds, None means disabled.
+    """
+    if not option:
+        return None
+    return 0 if option is True else option
+
+
+LOCAL_GET_CHANNEL = 'cacheops:local_get'
+ALL_TABLES = '*'
+
+
+class LocalGetCache(LRUCache):
+    """
+    Process local cache for local_get.
+
+    Entries expire after timeout and are dropped once their table is invalidated.
+    Invalidations are announced to other processes via redis pub/sub,
+    which is subscribed to on first write and listened in a background thread.
+    """
+    def __init__(self, size):
+        super(LocalGetCache, self).__init__(size)
+        self._listener_pid = None
+        self._listener_lock = threading.Lock()
+
+    def lookup(self, key):
+        entry = self.get(key)
+        if entry is None or entry[2] < time.time():
+            raise CacheMiss
+        return entry[1]
+
+    def set(self, key, value, db_table, timeout):
+        # We won't know when entry is invalidated without a subscription, so we don't keep it
+        if not self._ensure_listener():
+            return
+        self[key] = db_table, value, time.time() + timeout
+
+    def drop_table(self, db_table):
+        if db_table == ALL_TABLES:
+            return self.clear()
+        with self._lock:
+            stale = [key for key, entry in self._data.items() if entry[0] == db_table]
+            for key in stale:
+                del self._data[key]
+
+    def _ensure_listener(self):
+        # Threads don't survive fork, so we start one per process
+        if self._listener_pid == os.getpid():
+            return True
+        with self._listener_lock:
+            if self._listener_pid != os.getpid():
+                try:
+                    pubsub = self._subscribe()
+                except redis.RedisError:
+                    return False
+                self._listener_pid = os.getpid()
+                thread = threading.Thread(target=self._listen, args=(pubsub,),
+                                          name='cacheops-local-get')
+                thread.daemon = True
+                thread.start()
+        return True
+
+    def _subscribe(self):
+        pubsub = redis_client.pubsub()
+        try:
+            pubsub.subscribe(LOCAL_GET_CHANNEL)
+            # Wait for confirmation, invalidations published before it would be missed
+            message = None
+            while not message or message['type'] != 'subscribe':
+                message = pubsub.get_message(timeout=1)
+        except redis.RedisError:
+            pubsub.close()
+            raise
+        return pubsub
+
+    def _listen(self, pubsub):
+        while True:
+            try:
+                if pubsub is None:
+                    pubsub = self._subscribe()
+                    # Entries could have been written while we were not subscribed
+                    self.clear()
+                message = pubsub.get_message(timeout=1)
+                if message and message['type'] == 'message':
+                    self.drop_table(force_text(message['data']))
+            except redis.RedisError:
+                # We could have missed some invalidations
+                self.clear()
+                if pubsub is not None:
+                    pubsub.close()
+                    pubsub = None
+                time.sleep(1)
+
+local_get_cache = LocalGetCache(settings.CACHEOPS_LOCAL_GET_SIZE)
+
+
+@handle_connection_failure
+def drop_local_get(db_table):
+    local_get_cache.drop_table(db_table)
+    redis_client.publish(LOCAL_GET_CHANNEL, db_table)
@@ -1,9 +1,13 @@
 local prefix = KEYS[1]
 local key = KEYS[2]
 local precall_key = KEYS[3]
+local stale_key = KEYS[4]
 local data = ARGV[1]
 local dnfs = cjson.decode(ARGV[2])
 local timeout = tonumber(ARGV[3])
+local stale = tonumber(ARGV[4])
+local fields = ARGV[5]
+local compact = ARGV[6] == '1'
 
 if precall_key ~= '' and redis.call('exists', precall_key) == 0 then
   -- Cached data was invalidated during the function call. The data is
@@ -14,37 +18,96 @@ end
 -- Write data to cache
 redis.call('setex', key, timeout, data)
 
+-- Write a stale copy, which is not invalidated, but outlives the key for stale seconds,
+-- release a lock for its refresh and drop a flag of it being invalidated
+if stale_key ~= '' then
+    redis.call('setex', stale_key, timeout + stale, data)
+    redis.call('del', stale_key .. ':lock', key .. ':invalidated')
+end
+
 
 -- A pair of funcs
--- NOTE: we depend here on keys order being stable
+-- NOTE: fields are sorted so that the same set of fields always makes the same scheme and keys,
+--       invalidate.lua builds conj keys in scheme order.
 local conj_schema = function (conj)
-    local parts = {}
+    local names = {}
     for field, _ in pairs(conj) do
-        table.insert(parts, field)
+        table.insert(names, field)
     end
-
-    return table.concat(parts, ',')
+    table.sort(names)
+    return names
 end
 
-local conj_cache_key = function (db_table, conj)
+local conj_cache_key = function (conj_prefix, conj, names)
     local parts = {}
-    for field, val in pairs(conj) do
-        table.insert(parts, field .. '=' .. tostring(val))
+    for _, field in ipairs(names) do
+        table.insert(parts, field .. '=' .. tostring(conj[field]))
     end
 
-    return prefix .. 'conj:' .. db_table .. ':' .. table.concat(parts, '&')
+    return conj_prefix .. table.concat(parts, '&')
 end
 
+-- Compact keys have table and field names replaced with short ids,
+-- which are allocated on first use and never change
+local ids_key = prefix .. 'ids'
+local ids = {}
+local get_id = function (name)
+    if not ids[name] then
+        local id = redis.call('hget', ids_key, name)
+        if not id then
+            id = tostring(redis.call('hincrby', ids_key, '', 1))
+            redis.call('hset', ids_key, name, id)
+        end
+        ids[name] = id
+    end
+    return ids[name]
+end
+
+local encode_conj = function (conj)
+    local encoded = {}
+    for field, val in pairs(conj) do
+        encoded[get_id(field)] = val
+    end
+    return encoded
+end
+
+
+-- Register key along with fields it depends on if we know them,
+-- so that it would survive changes of other fields, see invalidate.lua
+local member = key
+if fields and fields ~= '' then
+    if compact then
+        local field_ids = {}
+        for field in string.gmatch(fields, "[^,]+") do
+            table.insert(field_ids, get_id(field))
+        end
+        fields = table.concat(field_ids, ',')
+    end
+    member = key .. ' ' .. fields
+end
 
 -- Update schemes and invalidators
 for db_table, disj in pairs(dnfs) do
+    local conjs_key = prefix .. 'conjs:' .. db_table
+    local conj_prefix = prefix .. 'conj:' .. db_table .. ':'
+    if compact then
+        conj_prefix = prefix .. 'j:' .. get_id(db_table) .. ':'
+    end
     for _, conj in ipairs(disj) do
-        -- Ensure scheme is known
-        redis.call('sadd', prefix .. 'schemes:' .. db_table, conj_schema(conj))
+        if compact then
+            conj = encode_conj(conj)
+        end
+        -- Ensure scheme is known and is not reaped if that is in progress, see reap_schemes()
+        local names = conj_schema(conj)
+        local scheme = table.concat(names, ',')
+        redis.call('sadd', prefix .. 'schemes:' .. db_table, scheme)
+        redis.call('srem', prefix .. 'schemes_reap:' .. db_table, scheme)
 
         -- Add new cache_key to list of dependencies
-        local conj_key = conj_cache_key(db_table, conj)
-        redis.call('sadd', conj_key, key)
+        local conj_key = conj_cache_key(conj_prefix, conj, names)
+        redis.call('sadd', conj_key, member)
+        -- Register conj key for the table to be able to invalidate it as a whole
+        redis.call('sadd', conjs_key, conj_key)
         -- NOTE: an invalidator should live longer than any key it references.
         --       So we update its ttl on every key if needed.
         -- NOTE: if CACHEOPS_LRU is True when invalidators should be left persistent,
@@ -55,6 +118,10 @@ for db_table, disj in pairs(dnfs) do
             -- We set conj_key life with a margin over key life to call expire rarer
             -- And add few extra seconds to be extra safe
             redis.call('expire', conj_key, timeout * 2 + 10)
+            -- Registry should outlive conj keys it references
+            if redis.call('ttl', conjs_key) < timeout * 2 + 10 then
+                redis.call('expire', conjs_key, timeout * 2 + 10)
+            end
         end
         -- /TOSTRIP
     end
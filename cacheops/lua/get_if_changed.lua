@@ -0,0 +1,9 @@
+local key = KEYS[1]
+local version = ARGV[1]
+
+-- Data still has the version we know, no need to transfer it
+if version ~= '' and redis.call('getrange', key, 0, #version - 1) == version then
+    return 1
+end
+
+return redis.call('get', key)
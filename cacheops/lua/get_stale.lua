@@ -0,0 +1,22 @@
+local stale_key = KEYS[1]
+local invalidated_key = KEYS[2]
+local on_invalidation = ARGV[1] == '1'
+local lock_timeout = ARGV[2]
+-- Whether caller may refresh data, it shouldn't when someone already calculates it
+local refresh = ARGV[3] == '1'
+
+-- Invalidation flags stale copies of keys it deletes, the rest have expired
+if not on_invalidation and redis.call('exists', invalidated_key) == 1 then
+    return nil
+end
+
+local data = redis.call('get', stale_key)
+if not data then
+    return nil
+end
+
+-- A single caller gets to refresh data, others are served stale one meanwhile
+if refresh and redis.call('set', stale_key .. ':lock', 'LOCK', 'nx', 'ex', lock_timeout) then
+    return 1
+end
+return data
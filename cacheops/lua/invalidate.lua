@@ -1,20 +1,51 @@
 local prefix = KEYS[1]
 local db_table = ARGV[1]
-local obj = cjson.decode(ARGV[2])
-local conj_del_fn = 'unlink'
+local objs = cjson.decode(ARGV[2])
+-- Fields changed, if we know them, otherwise anything could
+local changed = nil
+if ARGV[3] and ARGV[3] ~= '' then
+    changed = {}
+    for _, field in ipairs(cjson.decode(ARGV[3])) do
+        changed[field] = true
+    end
+end
+-- Max number of conj members to go through here, bigger conj keys are left to caller
+local budget = tonumber(ARGV[4])
+local compact = ARGV[5] == '1'
+local del_fn = 'unlink'
 -- If Redis version < 4.0 we can't use UNLINK
 -- TOSTRIP
-conj_del_fn = 'del'
+del_fn = 'del'
 -- /TOSTRIP
 
+local conj_prefix = prefix .. 'conj:' .. db_table .. ':'
+local changed_arg = ARGV[3] or ''
+
 -- Utility functions
+local glob_escape = function (s)
+    return (string.gsub(s, '[%*%?%[%]\\]', '\\%0'))
+end
+
+-- Fields absent from obj may have any value, which makes a glob pattern instead of a key
 local conj_cache_key = function (db_table, scheme, obj)
+    local is_pattern = false
+    for field in string.gmatch(scheme, "[^,]+") do
+        if obj[field] == nil then
+            is_pattern = true
+        end
+    end
+
+    local escape = is_pattern and glob_escape or tostring
     local parts = {}
     for field in string.gmatch(scheme, "[^,]+") do
-        table.insert(parts, field .. '=' .. tostring(obj[field]))
+        if obj[field] == nil then
+            table.insert(parts, field .. '=*')
+        else
+            table.insert(parts, field .. '=' .. escape(tostring(obj[field])))
+        end
     end
 
-    return prefix .. 'conj:' .. db_table .. ':' .. table.concat(parts, '&')
+    return escape(conj_prefix) .. table.concat(parts, '&'), is_pattern
 end
 
 local call_in_chunks = function (command, args)
@@ -24,24 +55,151 @@ local call_in_chunks = function (command, args)
     end
 end
 
+local insert_new = function (list, seen, item)
+    if not seen[item] then
+        seen[item] = true
+        table.insert(list, item)
+    end
+end
+
+-- Conj members are cache keys optionally followed by fields they depend on:
+--   "<cache_key> <field>,<field>,..."
+-- NOTE: prefix may contain spaces, but cache keys always have ':' after it, fields never do
+local parse_member = function (member)
+    local key, fields = string.match(member, '^(.*) ([^ :]+)$')
+    if key then
+        return key, fields
+    end
+    return member, nil
+end
+
+local is_affected = function (fields)
+    if not changed or not fields then
+        return true
+    end
+    for field in string.gmatch(fields, "[^,]+") do
+        if changed[field] then
+            return true
+        end
+    end
+    return false
+end
+
 
--- Calculate conj keys
-local conj_keys = {}
+-- Compact keys refer to table and fields by ids, see cache_thing.lua,
+-- so we translate names here, those never cached with have no ids
+if compact then
+    local names, seen_names = {db_table}, {[db_table] = true}
+    for _, obj in ipairs(objs) do
+        for field, _ in pairs(obj) do
+            insert_new(names, seen_names, field)
+        end
+    end
+    for field, _ in pairs(changed or {}) do
+        insert_new(names, seen_names, field)
+    end
+
+    local ids = {}
+    local values = redis.call('hmget', prefix .. 'ids', unpack(names))
+    for i, name in ipairs(names) do
+        ids[name] = values[i]
+    end
+    if not ids[db_table] then
+        return {{}, {}, changed_arg}
+    end
+
+    conj_prefix = prefix .. 'j:' .. ids[db_table] .. ':'
+    for i, obj in ipairs(objs) do
+        local encoded = {}
+        for field, val in pairs(obj) do
+            if ids[field] then
+                encoded[ids[field]] = val
+            end
+        end
+        objs[i] = encoded
+    end
+    if changed then
+        local encoded, changed_ids = {}, {}
+        for field, _ in pairs(changed) do
+            if ids[field] then
+                encoded[ids[field]] = true
+                table.insert(changed_ids, ids[field])
+            end
+        end
+        changed = encoded
+        changed_arg = cjson.encode(changed_ids)
+    end
+end
+
+
+-- Calculate conj keys, several objects may share them
+local conj_keys, seen_conj_keys = {}, {}
+local patterns, seen_patterns = {}, {}
 local schemes = redis.call('smembers', prefix .. 'schemes:' .. db_table)
-for _, scheme in ipairs(schemes) do
-    table.insert(conj_keys, conj_cache_key(db_table, scheme, obj))
+for _, obj in ipairs(objs) do
+    for _, scheme in ipairs(schemes) do
+        local conj_key, is_pattern = conj_cache_key(db_table, scheme, obj)
+        if is_pattern then
+            insert_new(patterns, seen_patterns, conj_key)
+        else
+            insert_new(conj_keys, seen_conj_keys, conj_key)
+        end
+    end
 end
 
 
--- Delete cache keys and refering conj keys
-if next(conj_keys) ~= nil then
-    local cache_keys = redis.call('sunion', unpack(conj_keys))
-    -- we delete cache keys since they are invalid
-    -- and conj keys as they will refer only deleted keys
-    redis.call(conj_del_fn, unpack(conj_keys))
-    if next(cache_keys) ~= nil then
-        -- NOTE: can't just do redis.call('del', unpack(...)) cause there is limit on number
-        --       of return values in lua.
-        call_in_chunks('del', cache_keys)
+-- Delete affected cache keys and conj keys refering only to them,
+-- the rest of conj keys are left with unaffected members
+local cache_keys, seen_cache_keys = {}, {}
+local dead_conj_keys = {}
+local deferred = {}
+local step = 1000
+for _, conj_key in ipairs(conj_keys) do
+    local size = budget and redis.call('scard', conj_key) or 0
+    if budget and size > budget then
+        table.insert(deferred, conj_key)
+    else
+        if budget then
+            budget = budget - size
+        end
+        local members = redis.call('smembers', conj_key)
+        local affected = {}
+        for _, member in ipairs(members) do
+            local key, fields = parse_member(member)
+            if is_affected(fields) then
+                insert_new(cache_keys, seen_cache_keys, key)
+                table.insert(affected, member)
+            end
+        end
+        if #affected == #members then
+            table.insert(dead_conj_keys, conj_key)
+        else
+            for i = 1, #affected, step do
+                local chunk_end = math.min(i + step - 1, #affected)
+                redis.call('srem', conj_key, unpack(affected, i, chunk_end))
+            end
+        end
     end
 end
+
+call_in_chunks(del_fn, dead_conj_keys)
+call_in_chunks(del_fn, cache_keys)
+-- Flag stale copies of deleted keys, so that they are not served as expired ones, see get_stale.lua
+for _, key in ipairs(cache_keys) do
+    local stale_ttl = redis.call('pttl', key .. ':stale')
+    if stale_ttl > 0 then
+        redis.call('psetex', key .. ':invalidated', stale_ttl, 1)
+    end
+end
+
+-- Remove deleted conj keys from registry
+local conjs_key = prefix .. 'conjs:' .. db_table
+for i = 1, #dead_conj_keys, step do
+    local chunk_end = math.min(i + step - 1, #dead_conj_keys)
+    redis.call('srem', conjs_key, unpack(dead_conj_keys, i, chunk_end))
+end
+
+-- Conj keys matching patterns are to be looked up in registry by caller,
+-- and deferred ones are to be gone through in chunks with changed fields as members refer to them,
+-- we can't do that here without blocking
+return {patterns, deferred, changed_arg}
@@ -0,0 +1,28 @@
+local conjs_key = KEYS[1]
+local conj_keys = ARGV
+local del_fn = 'unlink'
+-- If Redis version < 4.0 we can't use UNLINK
+-- TOSTRIP
+del_fn = 'del'
+-- /TOSTRIP
+
+-- Delete cache keys referred by given conj keys and conj keys themselves,
+-- then remove them from registry
+local cache_keys = redis.call('sunion', unpack(conj_keys))
+-- Strip fields cache keys depend on, see invalidate.lua
+for i, member in ipairs(cache_keys) do
+    cache_keys[i] = string.match(member, '^(.*) [^ :]+$') or member
+end
+local step = 1000
+for i = 1, #cache_keys, step do
+    redis.call(del_fn, unpack(cache_keys, i, math.min(i + step - 1, #cache_keys)))
+end
+-- Flag stale copies of deleted keys, so that they are not served as expired ones, see get_stale.lua
+for _, key in ipairs(cache_keys) do
+    local stale_ttl = redis.call('pttl', key .. ':stale')
+    if stale_ttl > 0 then
+        redis.call('psetex', key .. ':invalidated', stale_ttl, 1)
+    end
+end
+redis.call(del_fn, unpack(conj_keys))
+redis.call('srem', conjs_key, unpack(conj_keys))
@@ -0,0 +1,56 @@
+local conj_key = KEYS[1]
+local conjs_key = KEYS[2]
+local members = {unpack(ARGV, 2)}
+-- Fields changed, if we know them, otherwise anything could
+local changed = nil
+if ARGV[1] ~= '' then
+    changed = {}
+    for _, field in ipairs(cjson.decode(ARGV[1])) do
+        changed[field] = true
+    end
+end
+local del_fn = 'unlink'
+-- If Redis version < 4.0 we can't use UNLINK
+-- TOSTRIP
+del_fn = 'del'
+-- /TOSTRIP
+
+-- Delete affected cache keys from a chunk of conj key members, see invalidate.lua
+local cache_keys, affected = {}, {}
+for _, member in ipairs(members) do
+    -- Same as parse_member() in invalidate.lua
+    local key, fields = string.match(member, '^(.*) ([^ :]+)$')
+    if not key then
+        key = member
+    end
+
+    local is_affected = not changed or not fields
+    if not is_affected then
+        for field in string.gmatch(fields, "[^,]+") do
+            if changed[field] then
+                is_affected = true
+                break
+            end
+        end
+    end
+    if is_affected then
+        table.insert(cache_keys, key)
+        table.insert(affected, member)
+    end
+end
+
+if #affected > 0 then
+    redis.call(del_fn, unpack(cache_keys))
+    redis.call('srem', conj_key, unpack(affected))
+    -- Flag stale copies of deleted keys, so that they are not served as expired ones, see get_stale.lua
+    for _, key in ipairs(cache_keys) do
+        local stale_ttl = redis.call('pttl', key .. ':stale')
+        if stale_ttl > 0 then
+            redis.call('psetex', key .. ':invalidated', stale_ttl, 1)
+        end
+    end
+end
+-- Redis drops a set with its last member, then remove it from registry
+if redis.call('exists', conj_key) == 0 then
+    redis.call('srem', conjs_key, conj_key)
+end
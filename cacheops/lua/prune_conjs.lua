@@ -0,0 +1,13 @@
+local conjs_key = KEYS[1]
+local conj_keys = ARGV
+
+-- Remove expired or evicted conj keys from registry, return live ones
+local live = {}
+for _, conj_key in ipairs(conj_keys) do
+    if redis.call('exists', conj_key) == 1 then
+        table.insert(live, conj_key)
+    else
+        redis.call('srem', conjs_key, conj_key)
+    end
+end
+return live
@@ -0,0 +1,22 @@
+local schemes_key = KEYS[1]
+local reap_key = KEYS[2]
+local live = {}
+for _, scheme in ipairs(ARGV) do
+    live[scheme] = true
+end
+
+-- Candidates used by cache_thing.lua since reaping started are already removed,
+-- the rest are dead unless live conj keys were seen for them
+local dead = {}
+for _, scheme in ipairs(redis.call('smembers', reap_key)) do
+    if not live[scheme] then
+        table.insert(dead, scheme)
+    end
+end
+redis.call('del', reap_key)
+
+local step = 1000
+for i = 1, #dead, step do
+    redis.call('srem', schemes_key, unpack(dead, i, math.min(i + step - 1, #dead)))
+end
+return dead
@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+from cacheops.invalidation import merge_schemes
+from .reapschemes import Command as ReapSchemesCommand
+
+
+class Command(ReapSchemesCommand):
+    help = 'Merges invalidation schemes written in non-canonical order by older cacheops ' \
+           'for entire app or model'
+
+    def handle_one(self, model):
+        dropped = merge_schemes(model)
+        if dropped and self.verbosity > 1:
+            self.stdout.write('%s: merged %d schemes' % (model._meta.label, len(dropped)))
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import CommandError
+from django.apps import apps
+
+from cacheops.invalidation import reap_schemes
+from .invalidate import Command as InvalidateCommand
+
+
+class Command(InvalidateCommand):
+    help = 'Drops invalidation schemes no cached queries use anymore for entire app or model'
+    args = '(all | <app> | <app>.<model>) +'
+    label = 'app or model'
+
+    def handle_all(self):
+        for model in apps.get_models(include_auto_created=True):
+            self.handle_one(model)
+
+    def handle_app(self, app_name):
+        for model in self.get_app(app_name).get_models(include_auto_created=True):
+            self.handle_one(model)
+
+    def handle_model(self, app_name, model_name):
+        self.handle_one(self.get_model(app_name, model_name))
+
+    def handle_obj(self, app_name, model_name, obj_pk):
+        raise CommandError('Schemes are kept for entire models, not particular objects')
+
+    def handle_one(self, model):
+        dropped = reap_schemes(model)
+        if dropped and self.verbosity > 1:
+            self.stdout.write('%s: dropped %d schemes' % (model._meta.label, len(dropped)))
+
+    def handle(self, *labels, **options):
+        self.verbosity = options['verbosity']
+        return super(Command, self).handle(*labels, **options)
@@ -1,12 +1,14 @@
 # -*- coding: utf-8 -*-
-import sys
+import sys, time
+import copy
 import json
 import threading
 import six
 from random import random
-from funcy import select_keys, cached_property, once, once_per, monkey, wraps, walk, chain
+from funcy import select_keys, cached_property, once, once_per, monkey, wraps, walk, chain, \
+                  group_by, omit, merge
 from funcy.py3 import lmap, map, lcat, join_with
-from .cross import pickle, md5
+from .cross import md5
 
 import django
 from django.utils.encoding import smart_str, force_text
@@ -14,69 +16,224 @@ from django.core.exceptions import ImproperlyConfigured
 from django.db import DEFAULT_DB_ALIAS
 from django.db.models import Manager, Model
 from django.db.models.query import QuerySet
+from django.db.models.deletion import Collector
 from django.db.models.sql.datastructures import EmptyResultSet
+from django.db.models.lookups import Exact
+from django.db.models.expressions import F, Expression
 from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
 
 from .conf import model_profile, settings, ALL_OPS
-from .utils import monkey_mix, stamp_fields, func_cache_key, cached_view_fab, family_has_profile
+from .utils import monkey_mix, stamp_fields, func_cache_key, cached_view_fab, family_has_profile, \
+                   key_digest
 from .sharding import get_prefix
 from .redis import redis_client, handle_connection_failure, load_script
-from .tree import dnfs
-from .invalidation import invalidate_obj, invalidate_dict, no_invalidation
+from .tree import dnfs, dependent_fields
+from .invalidation import invalidate_obj, invalidate_objs, invalidate_dicts, invalidate_conds, \
+                          no_invalidation, postpone_invalidation, get_generations
+from .local import local_cache, local_get_cache, local_window, stamp_version, strip_version
 from .transaction import transaction_states
-from .signals import cache_read
+from .signals import cache_read, cache_compressed
+from .simple import CacheMiss
+from .serializers import get_serializer, serializer_stamp, BUILTIN_SERIALIZERS, \
+                         mark_raw, strip_raw, compress, decompress, compress_level, \
+                         stamp_expiry, strip_expiry, expires_early, early_beta, jitter_timeout
 
 
-__all__ = ('cached_as', 'cached_view_as', 'install_cacheops')
+__all__ = ('cached_as', 'cached_view_as', 'fetch_many', 'install_cacheops')
 
-_local_get_cache = {}
+# Lookup values we can safely and unambiguously put into a cache key as is
+SIMPLE_TYPES = six.integer_types + six.string_types
 
 
 @handle_connection_failure
-def cache_thing(prefix, cache_key, data, cond_dnfs, timeout, dbs=(), precall_key=''):
+def cache_thing(prefix, cache_key, data, cond_dnfs, timeout, dbs=(), precall_key='',
+                client=None, **kwargs):
     """
     Writes data to cache and creates appropriate invalidators.
 
     If precall_key is not the empty string, the data will only be cached if the
     precall_key is set to avoid caching stale data.
+
+    Pass a pipeline as client to batch several writes into a single round trip.
+    See pack_thing() for the rest of options.
     """
     # Could have changed after last check, sometimes superficially
     if transaction_states.is_dirty(dbs):
         return
-    load_script('cache_thing', settings.CACHEOPS_LRU)(
-        keys=[prefix, cache_key, precall_key],
-        args=[
-            pickle.dumps(data, -1),
-            json.dumps(cond_dnfs, default=str),
-            timeout
-        ]
-    )
+    keys, args = pack_thing(prefix, cache_key, data, cond_dnfs, timeout, precall_key, **kwargs)
+    load_script('cache_thing', settings.CACHEOPS_LRU)(keys=keys, args=args, client=client)
 
 
-def cached_as(*samples, **kwargs):
+def pack_thing(prefix, cache_key, data, cond_dnfs, timeout, precall_key='',
+               versioned=False, serializer=BUILTIN_SERIALIZERS['pickle'],
+               compress_level=0, compress_min_size=0, stale=0, compute_time=None, jitter=0,
+               fields=None):
     """
-    Caches results of a function and invalidates them same way as given queryset(s).
-    NOTE: Ignores queryset cached ops settings, always caches.
+    Prepares keys and args for cache_thing script.
 
-    If keep_fresh is True, this will prevent caching if the given querysets are
-    invalidated during the function call. This prevents prolonged caching of
-    stale data.
+    Versioned data is stamped for local cache to check in with it.
+    With stale a copy of data outliving it by stale seconds is written too.
+    Passing compute_time stamps data for early expiration, see expires_early().
+    Passing fields data depends on makes it survive changes to other fields.
     """
-    timeout = kwargs.pop('timeout', None)
-    extra = kwargs.pop('extra', None)
-    key_func = kwargs.pop('key_func', func_cache_key)
-    lock = kwargs.pop('lock', None)
-    keep_fresh = kwargs.pop('keep_fresh', False)
-    if not samples:
-        raise TypeError('Pass a queryset, a model or an object to cache like')
-    if kwargs:
-        raise TypeError('Unexpected keyword arguments %s' % ', '.join(kwargs))
-
-    # If we unexpectedly get list instead of queryset return identity decorator.
-    # Paginator could do this when page.object_list is empty.
-    if len(samples) == 1 and isinstance(samples[0], list):
-        return lambda func: func
+    if jitter:
+        timeout = jitter_timeout(timeout, jitter)
+    serialized_data = mark_raw(serializer.dumps(data))
+    if compress_level:
+        raw_size = len(serialized_data)
+        serialized_data = compress(serialized_data, compress_level, compress_min_size)
+        cache_compressed.send(sender=None, raw_size=raw_size, stored_size=len(serialized_data))
+    if compute_time is not None:
+        serialized_data = stamp_expiry(serialized_data, compute_time, timeout)
+    if versioned:
+        serialized_data = stamp_version(serialized_data)
+
+    keys = [prefix, cache_key, precall_key, cache_key + ':stale' if stale else '']
+    args = [serialized_data, json.dumps(cond_dnfs, default=str), timeout, stale,
+            ','.join(sorted(fields)) if fields else '', int(settings.CACHEOPS_COMPACT_KEYS)]
+    return keys, args
+
+
+def load_thing(cache_data, serializer=BUILTIN_SERIALIZERS['pickle']):
+    """
+    Loads data written by cache_thing()
+    """
+    return serializer.loads(strip_raw(decompress(strip_expiry(strip_version(cache_data)))))
+
+
+@handle_connection_failure
+def _execute_pipeline(pipe):
+    return pipe.execute()
+
+
+def _guards_misses(profile):
+    return profile['lock'] or profile['stale'] or profile['coalesce']
+
+
+def fetch_many(*querysets):
+    """
+    Evaluates several querysets at once.
+
+    Cache keys of all cacheable querysets are looked up with a single MGET,
+    only misses go to the database and are written back in one pipeline.
+    Returns a list of results in the same order as querysets passed.
+    """
+    # NOTE: querysets with lock, stale or coalesce enabled go the usual way,
+    #       since those protect from stampedes per key
+    batch = [qs for qs in querysets if qs._result_cache is None and qs._should_cache('fetch')
+                                       and not _guards_misses(qs._cacheprofile)]
+    if batch:
+        gens = {}
+        if settings.CACHEOPS_GENERATIONS:
+            # Look up generations for all querysets at once, a request per prefix
+            for prefix, prefix_qss in group_by(lambda qs: qs._prefix, batch).items():
+                gens[prefix] = get_generations(prefix, chain(*[qs._cond_dnfs for qs in prefix_qss]))
+        cache_keys = [qs._cache_key(gens=gens.get(qs._prefix)) for qs in batch]
+        cache_datas = redis_client.mget(cache_keys) or [None] * len(cache_keys)
+
+        misses = []
+        for qs, cache_key, cache_data in zip(batch, cache_keys, cache_datas):
+            if cache_data is not None and qs._expires_early(cache_data):
+                cache_data = None
+            cache_read.send(sender=qs.model, func=None, hit=cache_data is not None)
+            if cache_data is not None:
+                qs._result_cache = qs._load_results(cache_data)
+            else:
+                start = time.time()
+                qs._result_cache = qs._fetch_results()
+                misses.append((qs, cache_key, time.time() - start))
+
+        if misses:
+            pipe = redis_client.pipeline(transaction=False)
+            for qs, cache_key, compute_time in misses:
+                qs._cache_results(cache_key, qs._result_cache, client=pipe,
+                                  compute_time=compute_time)
+            _execute_pipeline(pipe)
 
+    # Fetch the rest and do prefetch_related() if needed
+    for qs in querysets:
+        qs._fetch_all()
+    return [qs._result_cache for qs in querysets]
+
+
+class CachedAs(object):
+    """
+    Parses cached_as() options and holds what's needed for caching,
+    shared by sync and async versions of it.
+    """
+    def __init__(self, samples, kwargs):
+        timeout = kwargs.pop('timeout', None)
+        extra = kwargs.pop('extra', None)
+        self.key_func = kwargs.pop('key_func', func_cache_key)
+        lock = kwargs.pop('lock', None)
+        coalesce = kwargs.pop('coalesce', None)
+        local = kwargs.pop('local_cache', None)
+        serializer = kwargs.pop('serializer', None)
+        compress_option = kwargs.pop('compress', None)
+        stale = kwargs.pop('stale', None)
+        stale_on_invalidation = kwargs.pop('stale_on_invalidation', None)
+        early = kwargs.pop('early', None)
+        jitter = kwargs.pop('jitter', None)
+        self.keep_fresh = kwargs.pop('keep_fresh', False)
+        if not samples:
+            raise TypeError('Pass a queryset, a model or an object to cache like')
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments %s' % ', '.join(kwargs))
+
+        # If we unexpectedly get list instead of queryset we should return identity decorator.
+        # Paginator could do this when page.object_list is empty.
+        self.noop = len(samples) == 1 and isinstance(samples[0], list)
+        if self.noop:
+            return
+
+        querysets = lmap(self._get_queryset, samples)
+        self.dbs = list({qs.db for qs in querysets})
+        self.cond_dnfs = join_with(lcat, map(dnfs, querysets))
+        self.key_extra = key_extra = [qs._cache_key(prefix=False) for qs in querysets]
+        key_extra.append(extra)
+        if timeout is None:
+            timeout = min(qs._cacheprofile['timeout'] for qs in querysets)
+        self.timeout = timeout
+        if lock is None:
+            lock = any(qs._cacheprofile['lock'] for qs in querysets)
+        self.lock = lock
+        if coalesce is None:
+            coalesce = any(qs._cacheprofile['coalesce'] for qs in querysets)
+        self.coalesce = coalesce
+
+        # Use serialization options all samples agree on or defaults
+        def common_option(name, default):
+            values = {qs._cacheprofile[name] for qs in querysets}
+            return values.pop() if len(values) == 1 else default
+
+        if serializer is None:
+            serializer = common_option('serializer', settings.CACHEOPS_SERIALIZER)
+        self.serializer = serializer = get_serializer(serializer)
+        if compress_option is None:
+            compress_option = common_option('compress', settings.CACHEOPS_COMPRESS)
+        self.compress_level = compress_level(compress_option)
+        self.compress_min_size = common_option('compress_min_size',
+                                               settings.CACHEOPS_COMPRESS_MIN_SIZE)
+        if serializer_stamp(serializer):
+            key_extra.append(serializer_stamp(serializer))
+        if stale is None:
+            stale = min(qs._cacheprofile['stale'] for qs in querysets)
+        self.stale = stale
+        if stale_on_invalidation is None:
+            stale_on_invalidation = all(qs._cacheprofile['stale_on_invalidation']
+                                        for qs in querysets)
+        self.stale_on_invalidation = stale_on_invalidation
+        self.early = early_beta(common_option('early', 0) if early is None else early)
+        self.jitter = common_option('jitter', 0) if jitter is None else jitter
+
+        # Only trust local cache as much as every sample allows
+        if local is None:
+            windows = [local_window(qs._cacheprofile['local_cache']) for qs in querysets]
+            self.window = None if None in windows else min(windows)
+        else:
+            self.window = local_window(local)
+
+    @staticmethod
     def _get_queryset(sample):
         if isinstance(sample, Model):
             queryset = sample.__class__.objects.filter(pk=sample.pk)
@@ -89,52 +246,100 @@ def cached_as(*samples, **kwargs):
 
         return queryset
 
-    querysets = lmap(_get_queryset, samples)
-    dbs = list({qs.db for qs in querysets})
-    cond_dnfs = join_with(lcat, map(dnfs, querysets))
-    key_extra = [qs._cache_key(prefix=False) for qs in querysets]
-    key_extra.append(extra)
-    if timeout is None:
-        timeout = min(qs._cacheprofile['timeout'] for qs in querysets)
-    if lock is None:
-        lock = any(qs._cacheprofile['lock'] for qs in querysets)
+    def enabled(self):
+        return settings.CACHEOPS_ENABLED and not transaction_states.is_dirty(self.dbs)
+
+    def prefix(self, func):
+        return get_prefix(func=func, _cond_dnfs=self.cond_dnfs, dbs=self.dbs)
+
+    def cache_key(self, func, args, kwargs, gens=None):
+        prefix = self.prefix(func)
+        key_extra = self.key_extra
+        if settings.CACHEOPS_GENERATIONS:
+            if gens is None:
+                gens = get_generations(prefix, self.cond_dnfs)
+            key_extra = key_extra + [sorted(gens.items())]
+        return prefix, prefix + 'as:' + self.key_func(func, args, kwargs, key_extra)
+
+    def precall_key(self, prefix, func, args, kwargs):
+        if not self.keep_fresh:
+            return ''
+        # We call this "asp" for "as precall" because this key is
+        # cached before the actual function is called. We randomize
+        # the key to prevent falsely thinking the key was not
+        # invalidated when in fact it was invalidated and the
+        # function was called again in another process.
+        suffix = self.key_func(func, args, kwargs, self.key_extra + [random()])
+        return prefix + 'asp:' + suffix
+
+    def getting_options(self):
+        return dict(lock=self.lock, stale=self.stale,
+                    stale_on_invalidation=self.stale_on_invalidation)
+
+    def expires_early(self, cache_data):
+        return bool(self.early) and expires_early(strip_version(cache_data), self.early)
+
+    def load(self, cache_data):
+        return load_thing(cache_data, serializer=self.serializer)
+
+    def thing_options(self, compute_time):
+        return dict(dbs=self.dbs, versioned=self.window is not None,
+                    serializer=self.serializer, compress_level=self.compress_level,
+                    compress_min_size=self.compress_min_size, stale=self.stale,
+                    compute_time=compute_time if self.early else None, jitter=self.jitter)
+
+
+def cached_as(*samples, **kwargs):
+    """
+    Caches results of a function and invalidates them same way as given queryset(s).
+    NOTE: Ignores queryset cached ops settings, always caches.
+
+    If keep_fresh is True, this will prevent caching if the given querysets are
+    invalidated during the function call. This prevents prolonged caching of
+    stale data.
+    """
+    params = CachedAs(samples, kwargs)
+    if params.noop:
+        return lambda func: func
 
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            if not settings.CACHEOPS_ENABLED or transaction_states.is_dirty(dbs):
+            if not params.enabled():
                 return func(*args, **kwargs)
 
-            prefix = get_prefix(func=func, _cond_dnfs=cond_dnfs, dbs=dbs)
-            cache_key = prefix + 'as:' + key_func(func, args, kwargs, key_extra)
+            prefix, cache_key = params.cache_key(func, args, kwargs)
+
+            if params.window is not None:
+                try:
+                    result = local_cache.lookup(cache_key, params.window, params.load)
+                    cache_read.send(sender=None, func=func, hit=True)
+                    return result
+                except CacheMiss:
+                    pass
 
-            with redis_client.getting(cache_key, lock=lock) as cache_data:
+            with redis_client.getting(cache_key, coalesce=params.coalesce,
+                                      **params.getting_options()) as cache_data:
+                if cache_data is not None and params.expires_early(cache_data):
+                    cache_data = None
                 cache_read.send(sender=None, func=func, hit=cache_data is not None)
                 if cache_data is not None:
-                    try:
-                        return pickle.loads(cache_data)
-                    except UnicodeDecodeError:
-                        return pickle.loads(cache_data, encoding='latin1')
+                    return params.load(cache_data)
                 else:
-                    if keep_fresh:
-                        # We call this "asp" for "as precall" because this key is
-                        # cached before the actual function is called. We randomize
-                        # the key to prevent falsely thinking the key was not
-                        # invalidated when in fact it was invalidated and the
-                        # function was called again in another process.
-                        suffix = key_func(func, args, kwargs, key_extra + [random()])
-                        precall_key = prefix + 'asp:' + suffix
+                    precall_key = params.precall_key(prefix, func, args, kwargs)
+                    if precall_key:
                         # Cache a precall_key to watch for invalidation during
                         # the function call. Its value does not matter. If and
                         # only if it remains valid before, during, and after the
                         # call, the result can be cached and returned.
-                        cache_thing(prefix, precall_key, 'PRECALL', cond_dnfs, timeout, dbs=dbs)
-                    else:
-                        precall_key = ''
+                        cache_thing(prefix, precall_key, 'PRECALL', params.cond_dnfs,
+                                    params.timeout, dbs=params.dbs)
 
+                    start = time.time()
                     result = func(*args, **kwargs)
-                    cache_thing(prefix, cache_key, result, cond_dnfs, timeout, dbs=dbs,
-                                precall_key=precall_key)
+                    cache_thing(prefix, cache_key, result, params.cond_dnfs, params.timeout,
+                                precall_key=precall_key,
+                                **params.thing_options(time.time() - start))
                     return result
 
         return wrapper
@@ -163,9 +368,12 @@ class QuerySetMixin(object):
                 'you can configure it with empty ops.'
                     % (self.model._meta.app_label, self.model._meta.model_name))
 
-    def _cache_key(self, prefix=True):
+    def _cache_key(self, prefix=True, gens=None):
         """
         Compute a cache key for this queryset
+
+        With CACHEOPS_GENERATIONS on, prefixed key includes generations of tables,
+        pass gens if these are already looked up.
         """
         md = md5()
         md.update('%s.%s' % (self.__class__.__module__, self.__class__.__name__))
@@ -173,19 +381,26 @@ class QuerySetMixin(object):
         md.update('%s.%s' % (self.model.__module__, self.model.__name__))
         # Protect from field list changes in model
         md.update(stamp_fields(self.model))
-        # Use query SQL as part of a key
-        try:
-            sql, params = self.query.get_compiler(self.db).as_sql()
+        # Use lookup by unique field or query SQL as part of a key
+        simple_cond = self._simple_cond()
+        if simple_cond:
+            md.update('%s=%r[%s:%s]' % simple_cond)
+        else:
             try:
-                sql_str = sql % params
-            except UnicodeDecodeError:
-                sql_str = sql % walk(force_text, params)
-            md.update(smart_str(sql_str))
-        except EmptyResultSet:
-            pass
-        # If query results differ depending on database
-        if self._cacheprofile and not self._cacheprofile['db_agnostic']:
-            md.update(self.db)
+                sql, params = self.query.get_compiler(self.db).as_sql()
+                try:
+                    sql_str = sql % params
+                except UnicodeDecodeError:
+                    sql_str = sql % walk(force_text, params)
+                md.update(smart_str(sql_str))
+            except EmptyResultSet:
+                pass
+        if self._cacheprofile:
+            # If query results differ depending on database
+            if not self._cacheprofile['db_agnostic']:
+                md.update(self.db)
+            # Don't confuse data written by different serializers
+            md.update(serializer_stamp(self._cacheprofile['serializer']))
         # Thing only appeared in Django 1.9
         it_class = getattr(self, '_iterable_class', None)
         if it_class:
@@ -193,10 +408,38 @@ class QuerySetMixin(object):
         # 'flat' attribute changes results formatting for values_list() in Django 1.8 and earlier
         if hasattr(self, 'flat'):
             md.update(str(self.flat))
+        # Bumping any of table generations makes this key unreachable
+        if prefix and settings.CACHEOPS_GENERATIONS:
+            if gens is None:
+                gens = get_generations(self._prefix, self._cond_dnfs)
+            md.update(repr(sorted((table, gens[table]) for table in self._cond_dnfs)))
 
-        cache_key = 'q:%s' % md.hexdigest()
+        cache_key = 'q:%s' % key_digest(md)
         return self._prefix + cache_key if prefix else cache_key
 
+    def _simple_cond(self):
+        """
+        Recognizes plain lookups by a unique field like .get(pk=1) or .filter(slug='hi'),
+        these can't return more than a single row, so we may skip SQL compilation
+        and make a key from field, value and slicing only.
+        Returns (attname, value, low_mark, high_mark) or None.
+        """
+        query = self.query
+        if len(query.where.children) != 1 or query.where.negated or len(query.alias_map) > 1 \
+                or query.select or query.select_related or query.annotations or query.extra \
+                or query.extra_tables or query.distinct or query.group_by \
+                or query.deferred_loading[0] or getattr(query, 'combinator', None):
+            return None
+
+        lookup = query.where.children[0]
+        if not isinstance(lookup, Exact) or not hasattr(lookup.lhs, 'target') \
+                or not isinstance(lookup.rhs, SIMPLE_TYPES):
+            return None
+        field = lookup.lhs.target
+        if not (field.primary_key or field.unique):
+            return None
+        return field.attname, lookup.rhs, query.low_mark, query.high_mark
+
     @cached_property
     def _prefix(self):
         return get_prefix(_queryset=self)
@@ -205,9 +448,50 @@ class QuerySetMixin(object):
     def _cond_dnfs(self):
         return dnfs(self)
 
-    def _cache_results(self, cache_key, results):
+    def _cache_results(self, cache_key, results, client=None, compute_time=None):
         cache_thing(self._prefix, cache_key, results,
-                    self._cond_dnfs, self._cacheprofile['timeout'], dbs=[self.db])
+                    self._cond_dnfs, self._cacheprofile['timeout'], dbs=[self.db], client=client,
+                    **self._thing_options(compute_time))
+
+    def _thing_options(self, compute_time=None):
+        profile = self._cacheprofile
+        return dict(versioned=bool(profile['local_cache']),
+                    serializer=profile['serializer'],
+                    compress_level=profile['compress'],
+                    compress_min_size=profile['compress_min_size'],
+                    stale=profile['stale'],
+                    compute_time=compute_time if profile['early'] else None,
+                    jitter=profile['jitter'],
+                    fields=self._dependent_fields())
+
+    def _dependent_fields(self):
+        # Fields only make sense for a single table, see invalidate.lua
+        if list(self._cond_dnfs) != [self.model._meta.db_table]:
+            return None
+        return dependent_fields(self)
+
+    def _load_results(self, cache_data):
+        return load_thing(cache_data, serializer=self._cacheprofile['serializer'])
+
+    def _expires_early(self, cache_data):
+        beta = self._cacheprofile['early']
+        return bool(beta) and expires_early(strip_version(cache_data), beta)
+
+    def _local_window(self):
+        # Prefetched objects are attached to instances, so we can't share them
+        if self._prefetch_related_lookups:
+            return None
+        return local_window(self._cacheprofile['local_cache'])
+
+    def _fetch_results(self):
+        # This thing appears in Django 1.9.
+        # In Djangos 1.9 and 1.10 both calls mean the same.
+        # Starting from Django 1.11 .iterator() uses chunked fetch
+        # while ._fetch_all() stays with bare _iterable_class.
+        if hasattr(self, '_iterable_class'):
+            return list(self._iterable_class(self))
+        else:
+            return list(self.iterator())
 
     def _should_cache(self, op):
         # If cache and op are enabled and not within write or dirty transaction
@@ -216,13 +500,14 @@ class QuerySetMixin(object):
             and not self._for_write \
             and not transaction_states[self.db].is_dirty()
 
-    def cache(self, ops=None, timeout=None, lock=None):
+    def cache(self, ops=None, timeout=None, lock=None, coalesce=None):
         """
         Enables caching for given ops
             ops        - a subset of {'get', 'fetch', 'count', 'exists', 'aggregate'},
                          ops caching to be turned on, all enabled by default
             timeout    - override default cache timeout
             lock       - use lock to prevent dog-pile effect
+            coalesce   - same as lock, but only between threads of a process
 
         NOTE: you actually can disable caching by omiting corresponding ops,
               .cache(ops=[]) disables caching for this queryset.
@@ -239,6 +524,8 @@ class QuerySetMixin(object):
             self._cacheprofile['timeout'] = timeout
         if lock is not None:
             self._cacheprofile['lock'] = lock
+        if coalesce is not None:
+            self._cacheprofile['coalesce'] = coalesce
 
         return self
 
@@ -307,24 +594,32 @@ class QuerySetMixin(object):
 
         cache_key = self._cache_key()
         lock = self._cacheprofile['lock']
+        stale = self._cacheprofile['stale']
+        stale_on_invalidation = self._cacheprofile['stale_on_invalidation']
 
-        with redis_client.getting(cache_key, lock=lock) as cache_data:
+        window = self._local_window()
+        if window is not None:
+            try:
+                self._result_cache = list(local_cache.lookup(cache_key, window,
+                                                             self._load_results))
+                cache_read.send(sender=self.model, func=None, hit=True)
+                return self._no_monkey._fetch_all(self)
+            except CacheMiss:
+                pass
+
+        with redis_client.getting(cache_key, lock=lock, stale=stale,
+                                  stale_on_invalidation=stale_on_invalidation,
+                                  coalesce=self._cacheprofile['coalesce']) as cache_data:
+            if cache_data is not None and self._expires_early(cache_data):
+                cache_data = None
             cache_read.send(sender=self.model, func=None, hit=cache_data is not None)
             if cache_data is not None:
-                try:
-                    self._result_cache = pickle.loads(cache_data)
-                except UnicodeDecodeError:
-                    self._result_cache = pickle.loads(cache_data, encoding='latin1')
+                self._result_cache = self._load_results(cache_data)
             else:
-                # This thing appears in Django 1.9.
-                # In Djangos 1.9 and 1.10 both calls mean the same.
-                # Starting from Django 1.11 .iterator() uses chunked fetch
-                # while ._fetch_all() stays with bare _iterable_class.
-                if hasattr(self, '_iterable_class'):
-                    self._result_cache = list(self._iterable_class(self))
-                else:
-                    self._result_cache = list(self.iterator())
-                self._cache_results(cache_key, self._result_cache)
+                start = time.time()
+                self._result_cache = self._fetch_results()
+                self._cache_results(cache_key, self._result_cache,
+                                    compute_time=time.time() - start)
 
         return self._no_monkey._fetch_all(self)
 
@@ -359,7 +654,7 @@ class QuerySetMixin(object):
         # so here we add 'fetch' to ops
         if self._should_cache('get'):
             # NOTE: local_get=True enables caching of simple gets in local memory,
-            #       which is very fast, but not invalidated.
+            #       which is very fast, but only invalidated by model as a whole.
             # Don't bother with Q-objects, select_related and previous filters,
             # simple gets - thats what we are really up to here.
             #
@@ -377,10 +672,12 @@ class QuerySetMixin(object):
                 #       Some day it could produce same key for diffrent requests.
                 key = (self.__class__, self.model) + tuple(sorted(kwargs.items()))
                 try:
-                    return _local_get_cache[key]
-                except KeyError:
-                    _local_get_cache[key] = self._no_monkey.get(self, *args, **kwargs)
-                    return _local_get_cache[key]
+                    return local_get_cache.lookup(key)
+                except CacheMiss:
+                    obj = self._no_monkey.get(self, *args, **kwargs)
+                    local_get_cache.set(key, obj, self.model._meta.db_table,
+                                        self._cacheprofile['timeout'])
+                    return obj
                 except TypeError:
                     # If some arg is unhashable we can't save it to dict key,
                     # we just skip local cache in that case
@@ -416,14 +713,50 @@ class QuerySetMixin(object):
     def bulk_create(self, objs, *args, **kwargs):
         objs = self._no_monkey.bulk_create(self, objs, *args, **kwargs)
         if family_has_profile(self.model):
-            for obj in objs:
-                invalidate_obj(obj, using=self.db)
+            invalidate_objs(objs, using=self.db)
         return objs
 
+    def update(self, **kwargs):
+        rows = self._no_monkey.update(self, **kwargs)
+        if self._invalidates_updates():
+            self._invalidate_update(kwargs)
+        return rows
+    update.alters_data = True
+
+    def _invalidates_updates(self):
+        profile = model_profile(self.model)
+        return bool(profile and profile['invalidate_updates'])
+
+    def _invalidate_update(self, kwargs):
+        """
+        Invalidates by update conditions without fetching objects:
+        objects matched them before update and match them with new values after.
+        """
+        opts = self.model._meta
+        conds = self._cond_dnfs.get(opts.db_table, [{}])
+
+        new_values, unknown = {}, set()
+        for name, value in kwargs.items():
+            field = opts.get_field(name)
+            if isinstance(value, (F, Expression)):
+                unknown.add(field.attname)
+            else:
+                if isinstance(value, Model):
+                    value = value.pk
+                new_values[field.attname] = field.get_prep_value(value)
+        new_conds = [omit(merge(cond, new_values), unknown) for cond in conds]
+
+        invalidate_conds(self.model, conds + new_conds, using=self.db,
+                         changed_fields=set(new_values) | unknown)
+
     def invalidated_update(self, **kwargs):
         clone = self._clone().nocache()
         clone._for_write = True  # affects routing
 
+        # Invalidated by conditions then
+        if self._invalidates_updates():
+            return clone.update(**kwargs)
+
         objects = list(clone)
         rows = clone.update(**kwargs)
 
@@ -432,8 +765,7 @@ class QuerySetMixin(object):
         # Using router with new_objects may fail, using self may return slave during lag.
         pks = {obj.pk for obj in objects}
         new_objects = self.model.objects.filter(pk__in=pks).using(clone.db)
-        for obj in chain(objects, new_objects):
-            invalidate_obj(obj, using=clone.db)
+        invalidate_objs(list(chain(objects, new_objects)), using=clone.db)
         return rows
 
 
@@ -468,23 +800,39 @@ class ManagerMixin(object):
         if cls.__module__ != '__fake__' and family_has_profile(cls):
             self._install_cacheops(cls)
 
-    def _pre_save(self, sender, instance, using, **kwargs):
-        if not (instance.pk is None or instance._state.adding or no_invalidation.active):
+    def _pre_save(self, sender, instance, using, update_fields=None, **kwargs):
+        if not (instance.pk is None or instance._state.adding or no_invalidation.active
+                or _ignores_fields(sender, update_fields)):
+            # Use values remembered on load if any, see ModelMixin.from_db()
+            snapshot = instance._state.__dict__.get('cacheops_snapshot')
+            if snapshot is not None and instance._state.db == using:
+                _old_objs.__dict__[sender, instance.pk] = sender(*snapshot)
+                return
             try:
                 _old_objs.__dict__[sender, instance.pk] \
                     = sender.objects.using(using).get(pk=instance.pk)
             except sender.DoesNotExist:
                 pass
 
-    def _post_save(self, sender, instance, using, **kwargs):
+    def _post_save(self, sender, instance, using, update_fields=None, **kwargs):
         if not settings.CACHEOPS_ENABLED:
             return
 
-        # Invoke invalidations for both old and new versions of saved object
+        # Invoke invalidations for both old and new versions of saved object,
+        # do it in a single call, so that conj keys they share are only processed once.
+        # Skip it altogether if only fields we ignore changed.
         old = _old_objs.__dict__.pop((sender, instance.pk), None)
-        if old:
-            invalidate_obj(old, using=using)
-        invalidate_obj(instance, using=using)
+        changed = _changed_fields(old, instance) if old else None
+        if not _ignores_fields(sender, update_fields) and not _ignores_fields(sender, changed):
+            invalidate_objs([old, instance] if old else [instance], using=using,
+                            changed_fields=changed)
+        # Saved state is now the old one for the next save
+        if settings.CACHEOPS_SNAPSHOT:
+            if update_fields is None:
+                _take_snapshot(instance)
+            else:
+                # Fields not updated might have been changed in instance
+                instance._state.__dict__.pop('cacheops_snapshot', None)
 
         # We run invalidations but skip caching if we are dirty
         if transaction_states[using].is_dirty():
@@ -542,6 +890,114 @@ class ManagerMixin(object):
         return self.get_queryset().inplace().invalidated_update(**kwargs)
 
 
+def _ignored_attnames(model):
+    profile = model_profile(model)
+    if not profile or not profile['ignore_fields']:
+        return None
+    return {model._meta.get_field(name).attname for name in profile['ignore_fields']}
+
+def _ignores_fields(model, fields):
+    """
+    Tells whether fields being saved or changed are all in ignore_fields profile option
+    """
+    if fields is None:
+        return False
+    ignored = _ignored_attnames(model)
+    return bool(ignored) and all(model._meta.get_field(name).attname in ignored
+                                 for name in fields)
+
+def _changed_fields(old, new):
+    """
+    Returns a set of attnames of fields differing in old and new objects,
+    None if we can't tell because some fields are deferred.
+    """
+    changed = set()
+    for field in new._meta.concrete_fields:
+        name = field.attname
+        if name not in old.__dict__ or name not in new.__dict__:
+            return None
+        value = new.__dict__[name]
+        if isinstance(value, (F, Expression)) or value != old.__dict__[name]:
+            changed.add(name)
+    return changed
+
+
+class CollectorMixin(object):
+    def delete(self):
+        # Invalidate everything deleted, cascades included, with a call per table
+        with postpone_invalidation:
+            return self._no_monkey.delete(self)
+
+
+class ModelMixin(object):
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        new = Model._no_monkey.from_db.__func__(cls, db, field_names, values)
+        # Remember loaded values to invalidate on them in save() without refetching,
+        # skip deferred ones not to load them later
+        if settings.CACHEOPS_SNAPSHOT and len(values) == len(cls._meta.concrete_fields):
+            new._state.cacheops_snapshot = values
+        return new
+
+    def refresh_from_db(self, *args, **kwargs):
+        self._state.__dict__.pop('cacheops_snapshot', None)
+        self._no_monkey.refresh_from_db(self, *args, **kwargs)
+
+    def __reduce__(self):
+        reduced = self._no_monkey.__reduce__(self)
+        if not settings.CACHEOPS_SNAPSHOT:
+            return reduced
+        # Don't bloat pickled, e.g. cached, data with snapshot when it could be retaken on load,
+        # mark objects having none instead, which is rare
+        state = reduced[2]['_state']
+        snapshot = state.__dict__.get('cacheops_snapshot')
+        if snapshot is None:
+            snapshot = False
+        elif list(snapshot) == _snapshot_values(self):
+            snapshot = None
+        else:
+            return reduced
+        # Old Djangos pass instance dict as is, so we copy before changing anything
+        data = reduced[2].copy()
+        data['_state'] = state = copy.copy(state)
+        if snapshot is None:
+            del state.cacheops_snapshot
+        else:
+            state.cacheops_snapshot = snapshot
+        return reduced[:2] + (data,) + reduced[3:]
+
+    def __setstate__(self, state):
+        self._no_monkey.__setstate__(self, state)
+        # Restore snapshot dropped in .__reduce__()
+        snapshot = self._state.__dict__.get('cacheops_snapshot')
+        if snapshot is False:
+            del self._state.cacheops_snapshot
+        elif snapshot is None and settings.CACHEOPS_SNAPSHOT:
+            _take_snapshot(self)
+
+
+def _snapshot_values(instance):
+    """
+    Returns instance concrete field values to remember,
+    None if some are deferred or are expressions.
+    """
+    try:
+        values = [instance.__dict__[f.attname] for f in instance._meta.concrete_fields]
+    except KeyError:
+        # Deferred fields are absent from instance dict
+        return None
+    if any(isinstance(v, (F, Expression)) for v in values):
+        return None
+    return values
+
+def _take_snapshot(instance):
+    values = _snapshot_values(instance)
+    if values is None:
+        instance._state.__dict__.pop('cacheops_snapshot', None)
+    else:
+        instance._state.cacheops_snapshot = values
+
+
 def invalidate_m2m(sender=None, instance=None, model=None, action=None, pk_set=None, reverse=None,
                    using=DEFAULT_DB_ALIAS, **kwargs):
     """
@@ -565,19 +1021,20 @@ def invalidate_m2m(sender=None, instance=None, model=None, action=None, pk_set=N
     if reverse:
         instance_column, model_column = model_column, instance_column
 
-    # TODO: optimize several invalidate_objs/dicts at once
     if action == 'pre_clear':
-        objects = sender.objects.using(using).filter(**{instance_column: instance.pk})
-        for obj in objects:
-            invalidate_obj(obj, using=using)
+        # NOTE: only fetch columns through objects are meaningful for,
+        #       there is no point in constructing model instances here.
+        columns = (sender._meta.pk.attname, instance_column, model_column)
+        rows = sender.objects.using(using).nocache() \
+                     .filter(**{instance_column: instance.pk}).values_list(*columns)
+        invalidate_dicts(sender, [dict(zip(columns, row)) for row in rows], using=using)
     elif action in ('post_add', 'pre_remove'):
         # NOTE: we don't need to query through objects here,
         #       cause we already know all their meaningfull attributes.
-        for pk in pk_set:
-            invalidate_dict(sender, {
-                instance_column: instance.pk,
-                model_column: pk
-            }, using=using)
+        invalidate_dicts(sender, [
+            {instance_column: instance.pk, model_column: pk}
+            for pk in pk_set
+        ], using=using)
 
 
 @once
@@ -587,6 +1044,8 @@ def install_cacheops():
     """
     monkey_mix(Manager, ManagerMixin)
     monkey_mix(QuerySet, QuerySetMixin)
+    monkey_mix(Model, ModelMixin)
+    monkey_mix(Collector, CollectorMixin)
 
     # Use app registry to introspect used apps
     from django.apps import apps
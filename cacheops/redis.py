@@ -1,4 +1,5 @@
 from __future__ import absolute_import
+import threading
 import warnings
 from contextlib import contextmanager
 import six
@@ -28,11 +29,94 @@ else:
 LOCK_TIMEOUT = 60
 
 
+class SingleFlight(object):
+    """
+    Lets a single thread of a process calculate data for a key at a time,
+    others wait for it to finish and then read its result from cache.
+    """
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def taking(self, key):
+        """
+        Yields True to a caller which is the first to take the key,
+        others wait for it to finish and get False.
+        """
+        with self._lock:
+            event = self._flights.get(key)
+            first = event is None
+            if first:
+                self._flights[key] = event = threading.Event()
+
+        if first:
+            try:
+                yield True
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                event.set()
+        else:
+            self.wait(event)
+            yield False
+
+    def wait(self, event):
+        event.wait(LOCK_TIMEOUT)
+
+flights = SingleFlight()
+
+
 class CacheopsRedis(redis.StrictRedis):
     get = handle_connection_failure(redis.StrictRedis.get)
+    mget = handle_connection_failure(redis.StrictRedis.mget)
 
     @contextmanager
-    def getting(self, key, lock=False):
+    def getting(self, key, lock=False, stale=0, stale_on_invalidation=False, coalesce=False):
+        """
+        Yields data for the key or None if caller should calculate and cache it.
+
+        With lock a single caller calculates at a time, others wait for it.
+        With stale, once key expires a single caller calculates, while others get
+        a stale copy of data, which is written along with data by cache_thing().
+        With coalesce, same as lock but only between threads of this process,
+        which is cheaper and could be combined with both of the above.
+        """
+        if not coalesce:
+            with self._getting(key, lock, stale, stale_on_invalidation) as data:
+                yield data
+            return
+
+        data = self.get(key)
+        if data is not None and data != b'LOCK':
+            yield data
+            return
+
+        with flights.taking(key) as first:
+            # Nothing else to check for the first one without lock or stale,
+            # so we skip the round trip
+            if first and not lock and not stale:
+                yield None
+            else:
+                with self._getting(key, lock, stale, stale_on_invalidation) as data:
+                    yield data
+
+    @contextmanager
+    def _getting(self, key, lock, stale, stale_on_invalidation):
+        if stale:
+            data = self.get(key)
+            # Key is locked while someone calculates it, see _get_or_lock()
+            calculating = data == b'LOCK'
+            if data is None or calculating:
+                data = self._get_stale(key, stale_on_invalidation, refresh=not calculating)
+            if data == 1:
+                # We are to refresh stale data
+                yield None
+                return
+            elif data is not None:
+                yield data
+                return
+
         if not lock:
             yield self.get(key)
         else:
@@ -47,19 +131,12 @@ class CacheopsRedis(redis.StrictRedis):
 
     @handle_connection_failure
     def _get_or_lock(self, key):
-        self._lock = getattr(self, '_lock', self.register_script("""
-            local locked = redis.call('set', KEYS[1], 'LOCK', 'nx', 'ex', ARGV[1])
-            if locked then
-                redis.call('del', KEYS[2])
-            end
-            return locked
-        """))
         signal_key = key + ':signal'
 
         while True:
             data = self.get(key)
             if data is None:
-                if self._lock(keys=[key, signal_key], args=[LOCK_TIMEOUT]):
+                if load_script('lock')(keys=[key, signal_key], args=[LOCK_TIMEOUT], client=self):
                     return None
             elif data != b'LOCK':
                 return data
@@ -67,17 +144,16 @@ class CacheopsRedis(redis.StrictRedis):
             # No data and not locked, wait
             self.brpoplpush(signal_key, signal_key, timeout=LOCK_TIMEOUT)
 
+    @handle_connection_failure
+    def _get_stale(self, key, on_invalidation, refresh=True):
+        return load_script('get_stale')(
+            keys=[key + ':stale', key + ':invalidated'],
+            args=[int(on_invalidation), LOCK_TIMEOUT, int(refresh)], client=self)
+
     @handle_connection_failure
     def _release_lock(self, key):
-        self._unlock = getattr(self, '_unlock', self.register_script("""
-            if redis.call('get', KEYS[1]) == 'LOCK' then
-                redis.call('del', KEYS[1])
-            end
-            redis.call('lpush', KEYS[2], 1)
-            redis.call('expire', KEYS[2], 1)
-        """))
         signal_key = key + ':signal'
-        self._unlock(keys=[key, signal_key])
+        load_script('unlock')(keys=[key, signal_key], client=self)
 
 
 @LazyObject
@@ -117,10 +193,14 @@ import os.path
 STRIP_RE = re.compile(r'TOSTRIP.*/TOSTRIP', re.S)
 
 @memoize
-def load_script(name, strip=False):
+def read_script(name, strip=False):
     filename = os.path.join(os.path.dirname(__file__), 'lua/%s.lua' % name)
     with open(filename) as f:
         code = f.read()
     if strip:
         code = STRIP_RE.sub('', code)
-    return redis_client.register_script(code)
+    return code
+
+@memoize
+def load_script(name, strip=False):
+    return redis_client.register_script(read_script(name, strip))
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+import math, random, struct, time
+import zlib
+from operator import itemgetter
+
+import six
+from django.apps import apps
+from django.db.models import Model
+from django.utils.module_loading import import_string
+
+from .cross import pickle
+
+
+__all__ = ('PickleSerializer', 'CompactSerializer', 'get_serializer', 'serializer_stamp',
+           'mark_raw', 'strip_raw', 'compress', 'decompress', 'stamp_expiry', 'strip_expiry',
+           'expires_early')
+
+
+class PickleSerializer(object):
+    def dumps(self, data):
+        return pickle.dumps(data, -1)
+
+    def loads(self, data):
+        try:
+            return pickle.loads(data)
+        except UnicodeDecodeError:
+            return pickle.loads(data, encoding='latin1')
+
+
+class CompactSerializer(PickleSerializer):
+    """
+    Stores lists of model instances as rows of field values plus a model reference
+    and rebuilds them with Model.from_db(), which is much faster than unpickling instances.
+    Anything else, including instances with annotations or related objects attached,
+    is pickled as is.
+    """
+    def dumps(self, data):
+        return super(CompactSerializer, self).dumps(self.pack(data))
+
+    def loads(self, data):
+        return self.unpack(super(CompactSerializer, self).loads(data))
+
+    def pack(self, data):
+        # NOTE: dicts and tuples from .values() and .values_list() are unpickled fast enough,
+        #       packing them into rows only makes loading slower, so they go as is.
+        if isinstance(data, list) and data and isinstance(data[0], Model):
+            return self._pack_models(data) or ('p', data)
+        return ('p', data)
+
+    def unpack(self, packed):
+        if packed[0] == 'm':
+            _, label, db, attnames, rows = packed
+            model = apps.get_model(label)
+            return [model.from_db(db, attnames, row) for row in rows]
+        else:
+            return packed[1]
+
+    def _pack_models(self, objs):
+        first = objs[0]
+        model, db = first.__class__, first._state.db
+        # Django 1.8/1.9 deferred classes are created on the fly and not registered,
+        # so another process couldn't look them up by label
+        if getattr(model, '_deferred', False):
+            return None
+        # Deferred fields are just absent from instance dict
+        attnames = tuple(f.attname for f in model._meta.concrete_fields
+                         if f.attname in first.__dict__)
+        # Anything else in dict is an annotation, a related object or similar
+        names = set(attnames) | {'_state'}
+        for obj in objs:
+            if obj.__class__ is not model or obj._state.db != db or obj._state.adding \
+                    or obj._state.__dict__.get('fields_cache') or set(obj.__dict__) != names:
+                return None
+
+        get_row = _row_getter(attnames)
+        rows = [get_row(obj.__dict__) for obj in objs]
+
+        label = '%s.%s' % (model._meta.app_label, model._meta.model_name)
+        return ('m', label, db, attnames, rows)
+
+
+def _row_getter(keys):
+    if len(keys) == 1:
+        key = keys[0]
+        return lambda d: (d[key],)
+    return itemgetter(*keys)
+
+
+BUILTIN_SERIALIZERS = {
+    'pickle': PickleSerializer(),
+    'compact': CompactSerializer(),
+}
+
+def get_serializer(serializer):
+    """
+    Resolves serializer setting, which is a builtin serializer name, an import path
+    or an object with .dumps() and .loads() methods.
+    """
+    if isinstance(serializer, six.string_types):
+        return BUILTIN_SERIALIZERS.get(serializer) or import_string(serializer)
+    return serializer
+
+def serializer_stamp(serializer):
+    """
+    Returns a string to vary cache keys on, so that data written by different serializers
+    won't be confused. Empty for the default pickle one to keep keys same.
+    """
+    if serializer is BUILTIN_SERIALIZERS['pickle']:
+        return ''
+    return getattr(serializer, '__name__', None) \
+        or '%s.%s' % (serializer.__class__.__module__, serializer.__class__.__name__)
+
+
+### Header bytes
+# NOTE: version stamp, compression and expiry header bytes are told from data by its first byte,
+#       pickles always start with PICKLE_LEAD, anything else is marked to not be mistaken for them.
+
+PICKLE_LEAD = b'\x80'
+RAW_MARK = b'\x03'
+
+def mark_raw(data):
+    """
+    Marks serialized data unless it's a pickle, e.g. from a custom serializer,
+    which could otherwise start with any header byte.
+    """
+    return data if data[:1] == PICKLE_LEAD else RAW_MARK + data
+
+def strip_raw(data):
+    return data[1:] if data[:1] == RAW_MARK else data
+
+
+### Compression
+
+COMPRESSED_MARK = b'\x01'
+
+def compress(data, level, min_size=0):
+    """
+    Compresses data if it's big enough and this makes it smaller.
+    Compressed data is marked with a header byte, so that it could coexist with plain one.
+    """
+    if not level or len(data) < min_size:
+        return data
+    compressed = COMPRESSED_MARK + zlib.compress(data, level)
+    return compressed if len(compressed) < len(data) else data
+
+def decompress(data):
+    if data[:1] == COMPRESSED_MARK:
+        return zlib.decompress(data[1:])
+    return data
+
+def compress_level(option):
+    """
+    Converts compress option to zlib compression level, 0 means disabled
+    """
+    return 6 if option is True else option or 0
+
+
+### Early expiration
+
+EXPIRY_MARK = b'\x02'
+EXPIRY_HEADER = struct.Struct('!dd')
+EXPIRY_LEN = 1 + EXPIRY_HEADER.size
+
+def stamp_expiry(data, compute_time, timeout):
+    """
+    Prepends time it took to calculate data and its expiration time to serialized data.
+    """
+    return EXPIRY_MARK + EXPIRY_HEADER.pack(compute_time, time.time() + timeout) + data
+
+def strip_expiry(data):
+    return data[EXPIRY_LEN:] if data[:1] == EXPIRY_MARK else data
+
+def expires_early(data, beta):
+    """
+    Decides whether data should be recalculated ahead of its expiration,
+    with probability rising as it approaches, see "Optimal Probabilistic Cache Stampede
+    Prevention" by Vattani et al. Longer calculations start earlier, bigger beta does too.
+    """
+    if data[:1] != EXPIRY_MARK:
+        return False
+    compute_time, expiry = EXPIRY_HEADER.unpack_from(data, 1)
+    return time.time() - compute_time * beta * math.log(1 - random.random()) >= expiry
+
+def early_beta(option):
+    """
+    Converts early option to XFetch beta, 0 means disabled
+    """
+    return 1.0 if option is True else option or 0
+
+def jitter_timeout(timeout, jitter):
+    """
+    Randomly shortens timeout by up to jitter share of it,
+    so that things cached together won't expire all at once.
+    """
+    return max(1, int(timeout * (1 - jitter * random.random())))
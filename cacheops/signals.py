@@ -2,3 +2,4 @@ import django.dispatch
 
 cache_read = django.dispatch.Signal(providing_args=["func", "hit"])
 cache_invalidated = django.dispatch.Signal(providing_args=["obj_dict"])
+cache_compressed = django.dispatch.Signal(providing_args=["raw_size", "stored_size"])
@@ -7,6 +7,9 @@ from funcy import wraps
 from .conf import settings
 from .utils import func_cache_key, cached_view_fab
 from .redis import redis_client, handle_connection_failure
+from .serializers import mark_raw, strip_raw, compress, decompress, compress_level, \
+                         stamp_expiry, strip_expiry, expires_early, early_beta, jitter_timeout
+from .signals import cache_compressed
 
 
 __all__ = ('cache', 'cached', 'cached_view', 'file_cache', 'CacheMiss', 'FileCache', 'RedisCache')
@@ -36,13 +39,17 @@ class BaseCache(object):
     """
     Simple cache with time-based invalidation
     """
-    def cached(self, timeout=None, extra=None, key_func=func_cache_key):
+    def cached(self, timeout=None, extra=None, key_func=func_cache_key, early=False, jitter=0):
         """
         A decorator for caching function calls
+
+        With early results are recalculated ahead of expiration with rising probability,
+        jitter randomly shortens timeout by up to that share of it.
         """
         # Support @cached (without parentheses) form
         if callable(timeout):
             return self.cached(key_func=key_func)(timeout)
+        beta = early_beta(early)
 
         def decorator(func):
             @wraps(func)
@@ -52,10 +59,12 @@ class BaseCache(object):
 
                 cache_key = 'c:' + key_func(func, args, kwargs, extra)
                 try:
-                    result = self.get(cache_key)
+                    result = self.get(cache_key, early=beta)
                 except CacheMiss:
+                    start = time.time()
                     result = func(*args, **kwargs)
-                    self.set(cache_key, result, timeout)
+                    compute_time = time.time() - start if beta else None
+                    self.set(cache_key, result, timeout, compute_time=compute_time, jitter=jitter)
 
                 return result
 
@@ -82,27 +91,52 @@ class RedisCache(BaseCache):
     def __init__(self, conn):
         self.conn = conn
 
-    def get(self, cache_key):
-        data = self.conn.get(cache_key)
-        if data is None:
-            raise CacheMiss
-        try:
-            return pickle.loads(data)
-        except UnicodeDecodeError:
-            return pickle.loads(data, encoding='latin1')
+    def get(self, cache_key, early=0):
+        return self.unpack(self.conn.get(cache_key), early)
 
     @handle_connection_failure
-    def set(self, cache_key, data, timeout=None):
-        pickled_data = pickle.dumps(data, -1)
+    def set(self, cache_key, data, timeout=None, compute_time=None, jitter=0):
+        data, timeout = self.pack(data, timeout, compute_time, jitter)
         if timeout is not None:
-            self.conn.setex(cache_key, timeout, pickled_data)
+            self.conn.setex(cache_key, timeout, data)
         else:
-            self.conn.set(cache_key, pickled_data)
+            self.conn.set(cache_key, data)
 
     @handle_connection_failure
     def delete(self, cache_key):
         self.conn.delete(cache_key)
 
+    @staticmethod
+    def pack(data, timeout=None, compute_time=None, jitter=0):
+        """
+        Serializes data for storing, returns it along with the timeout to store it for
+        """
+        pickled_data = mark_raw(pickle.dumps(data, -1))
+        level = compress_level(settings.CACHEOPS_COMPRESS)
+        if level:
+            raw_size = len(pickled_data)
+            pickled_data = compress(pickled_data, level, settings.CACHEOPS_COMPRESS_MIN_SIZE)
+            cache_compressed.send(sender=None, raw_size=raw_size, stored_size=len(pickled_data))
+        if timeout is not None:
+            if jitter:
+                timeout = jitter_timeout(timeout, jitter)
+            if compute_time is not None:
+                pickled_data = stamp_expiry(pickled_data, compute_time, timeout)
+        return pickled_data, timeout
+
+    @staticmethod
+    def unpack(data, early=0):
+        """
+        Loads data stored by .pack(), raises CacheMiss if there is none or it expires early
+        """
+        if data is None or early and expires_early(data, early):
+            raise CacheMiss
+        data = strip_raw(decompress(strip_expiry(data)))
+        try:
+            return pickle.loads(data)
+        except UnicodeDecodeError:
+            return pickle.loads(data, encoding='latin1')
+
 cache = RedisCache(redis_client)
 cached = cache.cached
 cached_view = cache.cached_view
@@ -125,7 +159,7 @@ class FileCache(BaseCache):
         digest = md5hex(key)
         return os.path.join(self._dir, digest[-2:], digest[:-2])
 
-    def get(self, key):
+    def get(self, key, early=0):
         filename = self._key_to_filename(key)
         try:
             # Remove file if it's stale
@@ -138,12 +172,15 @@ class FileCache(BaseCache):
         except (IOError, OSError, EOFError, pickle.PickleError):
             raise CacheMiss
 
-    def set(self, key, data, timeout=None):
+    def set(self, key, data, timeout=None, compute_time=None, jitter=0):
+        # NOTE: files are not stamped for early expiration, only jitter is supported
         filename = self._key_to_filename(key)
         dirname = os.path.dirname(filename)
 
         if timeout is None:
             timeout = self._default_timeout
+        if jitter:
+            timeout = jitter_timeout(timeout, jitter)
 
         try:
             if not os.path.exists(dirname):
@@ -1,14 +1,17 @@
 # -*- coding: utf-8 -*-
 from itertools import product
+import six
 from funcy import group_by, join_with
 from funcy.py3 import lcat, lmap
 
 import django
+from django.core.exceptions import FieldDoesNotExist
 from django.db.models.query import QuerySet
 from django.db.models.sql import OR
 from django.db.models.sql.query import Query, ExtraWhere
 from django.db.models.sql.where import NothingNode, SubqueryConstraint
 from django.db.models.lookups import Lookup, Exact, In, IsNull
+from django.db.models.expressions import Col
 # This thing existed in Django 1.8 and earlier
 try:
     from django.db.models.sql.where import EverythingNode
@@ -145,3 +148,78 @@ def dnfs(qs):
         return join_with(lcat, (query_dnf(q) for q in qs.query.combined_queries))
     else:
         return query_dnf(qs.query)
+
+
+class _Unknown(Exception):
+    pass
+
+def dependent_fields(qs):
+    """
+    Returns a set of attnames of fields queryset results depend on:
+    selected ones, used in conditions and ordering.
+
+    Returns None when all fields are selected or it's hard to tell,
+    e.g. for querysets with joins, subqueries, annotations or extra.
+    """
+    query = qs.query
+    opts = query.get_meta()
+    joins = [alias for alias in query.alias_map
+             if query.alias_refcount[alias] and alias != opts.db_table]
+    if joins or opts.parents or query.annotations \
+            or query.extra or query.extra_tables or query.extra_order_by \
+            or query.select_related or query.group_by or query.distinct_fields \
+            or getattr(query, 'combinator', None):
+        return None
+
+    def cols(expr):
+        if isinstance(expr, (QuerySet, Query, Subquery, RawSQL, ExtraWhere, SubqueryConstraint)):
+            raise _Unknown
+        if isinstance(expr, Col):
+            yield expr.target.attname
+        elif isinstance(expr, (list, tuple)):
+            for e in expr:
+                for col in cols(e):
+                    yield col
+        elif hasattr(expr, 'get_source_expressions'):
+            for e in expr.get_source_expressions():
+                for col in cols(e):
+                    yield col
+
+    def where_fields(where):
+        if isinstance(where, Lookup):
+            return set(cols(where.lhs)) | set(cols(where.rhs))
+        elif isinstance(where, (ExtraWhere, SubqueryConstraint)):
+            raise _Unknown
+        else:
+            return set(lcat(where_fields(child) for child in getattr(where, 'children', ())))
+
+    def order_field(name):
+        if not isinstance(name, six.string_types) or '__' in name:
+            raise _Unknown
+        name = name.lstrip('-')
+        if name == '?':
+            return None
+        field = opts.pk if name == 'pk' else opts.get_field(name)
+        # Ordering by relation uses related model ordering
+        if field.is_relation and name != field.attname:
+            raise _Unknown
+        return field.attname
+
+    try:
+        attnames = {f.attname for f in opts.concrete_fields}
+        if query.select:
+            selected = set(cols(query.select))
+        else:
+            names, defer = query.deferred_loading
+            if any('__' in name for name in names):
+                return None
+            names = {opts.get_field(name).attname for name in names}
+            selected = attnames - names if defer else names & attnames | {opts.pk.attname}
+        # Nothing to gain when all are selected
+        if selected >= attnames:
+            return None
+        ordering = query.order_by or (opts.ordering if query.default_ordering else ())
+        ordered = {order_field(name) for name in ordering} - {None}
+        return selected | where_fields(query.where) | ordered
+    except (_Unknown, FieldDoesNotExist):
+        return None
@@ -1,15 +1,16 @@
 # -*- coding: utf-8 -*-
 import re
 import json
+import base64
 import inspect
 from funcy import memoize, compose, wraps, any, any_fn, select_values
 from funcy.py3 import lmapcat
-from .cross import md5hex
+from .cross import md5, md5hex
 
 from django.db import models
 from django.http import HttpRequest
 
-from .conf import model_profile
+from .conf import model_profile, settings
 
 
 def get_concrete_model(model):
@@ -34,6 +35,10 @@ def model_family(model):
 def family_has_profile(cls):
     return any(model_profile, model_family(cls))
 
+@memoize
+def family_has_local_get(cls):
+    return any(p and p['local_get'] for p in map(model_profile, model_family(cls)))
+
 
 class MonkeyProxy(object):
     pass
@@ -73,6 +78,15 @@ def stamp_fields(model):
 
 ### Cache keys calculation
 
+def key_digest(md):
+    """
+    Returns hex digest of md5 object or a shorter base64 one if CACHEOPS_COMPACT_KEYS is on.
+    """
+    if settings.CACHEOPS_COMPACT_KEYS:
+        return base64.urlsafe_b64encode(md.digest()).rstrip(b'=').decode('ascii')
+    return md.hexdigest()
+
+
 def obj_key(obj):
     if isinstance(obj, models.Model):
         return '%s.%s.%s' % (obj._meta.app_label, obj._meta.model_name, obj.pk)
@@ -90,7 +104,7 @@ def func_cache_key(func, args, kwargs, extra=None):
     Calculate cache key based on func and arguments
     """
     factors = [func, args, kwargs, extra]
-    return md5hex(json.dumps(factors, sort_keys=True, default=obj_key))
+    return key_digest(md5(json.dumps(factors, sort_keys=True, default=obj_key)))
 
 def view_cache_key(func, args, kwargs, extra=None):
     """
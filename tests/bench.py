@@ -1,7 +1,8 @@
-from cacheops import invalidate_obj, invalidate_model
+from cacheops import invalidate_obj, invalidate_objs, invalidate_model
 from cacheops.redis import redis_client
 from cacheops.cross import pickle
 from cacheops.tree import dnfs
+from cacheops.serializers import CompactSerializer
 
 from .models import Category, Post, Extra
 
@@ -15,6 +16,39 @@ def do_pickle():
 def do_unpickle():
     pickle.loads(posts_pickle)
 
+# Make more posts to see a difference
+attnames = [f.attname for f in Post._meta.concrete_fields]
+many_posts = [Post.from_db('default', attnames, [p.__dict__[a] for a in attnames])
+              for p in posts * 100]
+many_posts_pickle = pickle.dumps(many_posts, -1)
+
+def do_pickle_many():
+    pickle.dumps(many_posts, -1)
+
+def do_unpickle_many():
+    pickle.loads(many_posts_pickle)
+
+compact = CompactSerializer()
+many_posts_compact = compact.dumps(many_posts)
+
+def do_compact_dumps():
+    compact.dumps(many_posts)
+
+def do_compact_loads():
+    compact.loads(many_posts_compact)
+
+values = [p.__dict__.copy() for p in many_posts]
+for v in values:
+    del v['_state']
+values_pickle = pickle.dumps(values, -1)
+values_compact = compact.dumps(values)
+
+def do_unpickle_values():
+    pickle.loads(values_pickle)
+
+def do_compact_loads_values():
+    compact.loads(values_compact)
+
 
 get_key = Category.objects.filter(pk=1).order_by()._cache_key()
 def invalidate_get():
@@ -60,6 +94,10 @@ filter_qs = Category.objects.filter(pk=1)
 def do_filter_cache_key():
     filter_qs._cache_key()
 
+sql_filter_qs = Category.objects.filter(title='Django')
+def do_sql_filter_cache_key():
+    sql_filter_qs._cache_key()
+
 
 def do_common_construct():
     return Category.objects.filter(pk=1).exclude(title__contains='Hi').order_by('title')[:20]
@@ -157,10 +195,31 @@ def prepare_cache():
 def do_invalidate_model(obj):
     invalidate_model(obj.__class__)
 
+def prepare_many():
+    prepare_cache()
+    return [Extra(pk=i, post_id=1, tag=i, to_tag_id=i) for i in range(100)]
+
+def do_invalidate_loop(objs):
+    for obj in objs:
+        invalidate_obj(obj)
+
+def do_invalidate_objs(objs):
+    invalidate_objs(objs)
+
+def prepare_save():
+    prepare_cache()
+    return Extra.objects.get(pk=1)
+
 
 TESTS = [
     ('pickle', {'run': do_pickle}),
     ('unpickle', {'run': do_unpickle}),
+    ('pickle_many', {'run': do_pickle_many}),
+    ('unpickle_many', {'run': do_unpickle_many}),
+    ('compact_dumps', {'run': do_compact_dumps}),
+    ('compact_loads', {'run': do_compact_loads}),
+    ('unpickle_values', {'run': do_unpickle_values}),
+    ('compact_values', {'run': do_compact_loads_values}),
 
     ('get_nocache', {'run': do_get_nocache}),
     ('get_hit', {'prepare_once': do_get, 'run': do_get}),
@@ -177,6 +236,7 @@ TESTS = [
     ('fetch_cache_key', {'run': do_fetch_cache_key}),
 
     ('filter_cache_key', {'run': do_filter_cache_key}),
+    ('sql_filter_key', {'run': do_sql_filter_cache_key}),
     ('common_construct', {'run': do_common_construct}),
     ('common_inplace', {'run': do_common_inplace}),
     ('common_cache_key', {'run': do_common_cache_key}),
@@ -195,4 +255,7 @@ TESTS = [
 
     ('big_invalidate', {'prepare': prepare_cache, 'run': do_invalidate_obj}),
     ('model_invalidate', {'prepare': prepare_cache, 'run': do_invalidate_model}),
+    ('invalidate_loop', {'prepare': prepare_many, 'run': do_invalidate_loop}),
+    ('invalidate_objs', {'prepare': prepare_many, 'run': do_invalidate_objs}),
+    ('big_save', {'prepare': prepare_save, 'run': do_save_obj}),
 ]
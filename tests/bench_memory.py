@@ -0,0 +1,32 @@
+from django.test import override_settings
+
+from cacheops import invalidate_all
+from cacheops.redis import redis_client
+
+from .models import Post
+
+
+QUERIES = 1000
+
+def cache_queries():
+    for i in range(QUERIES // 2):
+        list(Post.objects.cache().filter(title='Post number %d' % i))
+        list(Post.objects.cache().filter(category=i, visible=True))
+
+def memory_usage():
+    usage = {'data': 0, 'invalidators': 0}
+    for key in redis_client.scan_iter(count=1000):
+        kind = 'data' if b'q:' in key else 'invalidators'
+        usage[kind] += redis_client.memory_usage(key)
+    return usage
+
+
+def run_memory_benchmarks():
+    for name, compact in [('plain_keys', False), ('compact_keys', True)]:
+        with override_settings(CACHEOPS_COMPACT_KEYS=compact):
+            invalidate_all()
+            cache_queries()
+            usage = memory_usage()
+        print('%-18s bytes per query: data %d, invalidators %d'
+              % (name, usage['data'] / QUERIES, usage['invalidators'] / QUERIES))
+    invalidate_all()
@@ -184,6 +184,11 @@ class Local(models.Model):
     tag = models.IntegerField(null=True)
 
 
+# local_cache
+class LocalCached(models.Model):
+    tag = models.IntegerField(null=True)
+
+
 # 45
 class CacheOnSaveModel(models.Model):
     title = models.CharField(max_length=32)
@@ -95,6 +95,7 @@ CACHEOPS_DEFAULTS = {
 }
 CACHEOPS = {
     'tests.local': {'local_get': True},
+    'tests.localcached': {'local_cache': True},
     'tests.cacheonsavemodel': {'cache_on_save': True},
     'tests.dbbinded': {'db_agnostic': False},
     'tests.*': {},
@@ -107,6 +108,7 @@ if os.environ.get('CACHEOPS_PREFIX'):
     CACHEOPS_PREFIX = lambda q: 'p:'
 
 CACHEOPS_LRU = bool(os.environ.get('CACHEOPS_LRU'))
+CACHEOPS_COMPACT_KEYS = bool(os.environ.get('CACHEOPS_COMPACT_KEYS'))
 CACHEOPS_DEGRADE_ON_FAILURE = bool(os.environ.get('CACHEOPS_DEGRADE_ON_FAILURE'))
 ALLOWED_HOSTS = ['testserver']
 
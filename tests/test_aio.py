@@ -0,0 +1,123 @@
+from unittest import skipIf
+from django.test import override_settings
+
+from .utils import BaseTestCase, make_inc
+from .models import Category, Local
+
+try:
+    import asyncio
+    from cacheops import aio
+except (ImportError, SyntaxError):
+    aio = None
+
+
+def run(coro):
+    if not hasattr(run, 'loop'):
+        run.loop = asyncio.new_event_loop()
+    return run.loop.run_until_complete(coro)
+
+
+def make_ainc(deco):
+    inc = make_inc()
+    # Return a coroutine without using async syntax
+    ainc = deco(lambda _=None: asyncio.sleep(0, result=inc()))
+    ainc.get = inc.get
+    return ainc
+
+
+@skipIf(aio is None, "Requires Python 3.7+ and redis-py 4.2+")
+class AsyncTests(BaseTestCase):
+    def test_acached_as(self):
+        get_calls = make_ainc(aio.acached_as(Category))
+
+        self.assertEqual(run(get_calls()), 1)
+        self.assertEqual(run(get_calls()), 1)
+        Category.objects.create(title='test')
+        self.assertEqual(run(get_calls()), 2)
+
+    def test_acached_as_lock(self):
+        get_calls = make_ainc(aio.acached_as(Category, lock=True))
+
+        self.assertEqual(run(get_calls()), 1)
+        self.assertEqual(run(get_calls()), 1)
+
+    def test_acached(self):
+        get_calls = make_ainc(aio.acached(timeout=60))
+
+        self.assertEqual(run(get_calls()), 1)
+        self.assertEqual(run(get_calls()), 1)
+        run(get_calls.invalidate())
+        self.assertEqual(run(get_calls()), 2)
+
+    def test_afetch(self):
+        Category.objects.create(title='test')
+        run(aio.afetch(Category.objects.cache()))
+
+        with self.assertNumQueries(0):
+            results = run(aio.afetch(Category.objects.cache()))
+        self.assertEqual([c.title for c in results], ['test'])
+
+        Category.objects.create(title='other')
+        with self.assertNumQueries(1):
+            self.assertEqual(len(run(aio.afetch(Category.objects.cache()))), 2)
+
+    def test_afetch_not_cached(self):
+        Category.objects.create(title='test')
+
+        with self.assertNumQueries(1):
+            self.assertEqual(len(run(aio.afetch(Category.objects.nocache()))), 1)
+
+    def test_ainvalidate_obj(self):
+        c = Category.objects.create(title='test')
+        list(Category.objects.cache().filter(title='test'))
+
+        with self.assertNumQueries(0):
+            list(Category.objects.cache().filter(title='test'))
+        run(aio.ainvalidate_obj(c))
+        with self.assertNumQueries(1):
+            list(Category.objects.cache().filter(title='test'))
+
+    @override_settings(CACHEOPS_INVALIDATE_BUDGET=1)
+    def test_ainvalidate_obj_big_conj_key(self):
+        c = Category.objects.create(title='test')
+        list(Category.objects.cache().filter(title='test'))
+        list(Category.objects.cache().filter(title='test').order_by('pk'))
+
+        run(aio.ainvalidate_obj(c))
+        with self.assertNumQueries(2):
+            list(Category.objects.cache().filter(title='test'))
+            list(Category.objects.cache().filter(title='test').order_by('pk'))
+
+    def test_ainvalidate_dict_partial(self):
+        list(Category.objects.cache().filter(title='test'))
+        list(Category.objects.cache().filter(title='other'))
+
+        # Any title may match
+        run(aio.ainvalidate_dict(Category, {'id': 1}))
+        with self.assertNumQueries(2):
+            list(Category.objects.cache().filter(title='test'))
+            list(Category.objects.cache().filter(title='other'))
+
+    def test_ainvalidate_model(self):
+        list(Category.objects.cache())
+        run(aio.ainvalidate_model(Category))
+        with self.assertNumQueries(1):
+            list(Category.objects.cache())
+
+    @override_settings(CACHEOPS_GENERATIONS=True)
+    def test_ainvalidate_model_generations(self):
+        run(aio.afetch(Category.objects.cache()))
+        run(aio.ainvalidate_model(Category))
+        with self.assertNumQueries(1):
+            run(aio.afetch(Category.objects.cache()))
+        with self.assertNumQueries(0):
+            run(aio.afetch(Category.objects.cache()))
+
+    def test_ainvalidate_all(self):
+        from cacheops.local import local_get_cache
+
+        Local.objects.create(tag=1)
+        Local.objects.cache().get(pk=1)
+        self.assertEqual(len(local_get_cache), 1)
+        run(aio.ainvalidate_all())
+        self.assertEqual(len(local_get_cache), 0)
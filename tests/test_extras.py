@@ -1,13 +1,21 @@
+import re
+import time
+import pickle
+import mock
+
 from django.db import connections
 from django.test import TestCase
 from django.test import override_settings
 
-from cacheops import cached_as, no_invalidation, invalidate_obj, invalidate_model, invalidate_all
-from cacheops.conf import settings
-from cacheops.signals import cache_read, cache_invalidated
+from cacheops import cached_as, no_invalidation, postpone_invalidation, invalidate_obj, \
+                    invalidate_objs, invalidate_model, invalidate_all, fetch_many
+from cacheops import CacheMiss, invalidation
+from cacheops.conf import settings, model_profile
+from cacheops.redis import redis_client
+from cacheops.signals import cache_read, cache_invalidated, cache_compressed
 
 from .utils import BaseTestCase, make_inc
-from .models import Post, Category, Local, DbAgnostic, DbBinded
+from .models import Post, Category, Local, LocalCached, DbAgnostic, DbBinded, Brand, Label
 
 
 class SettingsTests(TestCase):
@@ -123,6 +131,800 @@ class LockingTests(BaseTestCase):
         self.assertEqual(results[0], results[1])
 
 
+class CoalesceTests(BaseTestCase):
+    def _concurrent_calls(self, func):
+        import threading
+        from .utils import ThreadWithReturnValue
+        from before_after import before
+
+        results = []
+        waiting = threading.Event()
+        thread = [None]
+
+        def second_thread():
+            def _target():
+                try:
+                    with before('cacheops.redis.SingleFlight.wait', lambda *a: waiting.set()):
+                        results.append(func())
+                except Exception:
+                    waiting.set()
+                    raise
+
+            thread[0] = ThreadWithReturnValue(target=_target)
+            thread[0].start()
+            assert waiting.wait(1)  # Wait until the second thread waits for us
+
+        with before('random.random', second_thread):
+            results.append(func())
+
+        thread[0].join()
+        return results
+
+    def test_cached_as(self):
+        import random
+
+        @cached_as(Post, coalesce=True, timeout=60)
+        def func():
+            return random.random()
+
+        results = self._concurrent_calls(func)
+        self.assertEqual(results[0], results[1])
+
+    def test_cached_as_with_lock(self):
+        import random
+
+        @cached_as(Post, coalesce=True, lock=True, timeout=60)
+        def func():
+            return random.random()
+
+        results = self._concurrent_calls(func)
+        self.assertEqual(results[0], results[1])
+
+    def test_leader_fails(self):
+        from cacheops.redis import flights
+
+        with self.assertRaises(ZeroDivisionError):
+            with flights.taking('key') as first:
+                self.assertTrue(first)
+                1 / 0
+        with flights.taking('key') as first:
+            self.assertTrue(first)
+
+
+class BatchInvalidationTests(BaseTestCase):
+    def _script_calls(self):
+        from cacheops.redis import load_script
+        return mock.patch('cacheops.invalidation.load_script', wraps=load_script)
+
+    def test_invalidate_objs(self):
+        c1 = Category.objects.create(title='a')
+        c2 = Category.objects.create(title='b')
+        list(Category.objects.cache().filter(title='a'))
+        list(Category.objects.cache().filter(title='b'))
+
+        with self._script_calls() as load_script:
+            invalidate_objs([c1, c2])
+        self.assertEqual(load_script.call_count, 1)
+
+        with self.assertNumQueries(2):
+            list(Category.objects.cache().filter(title='a'))
+            list(Category.objects.cache().filter(title='b'))
+
+    def test_dedup(self):
+        from cacheops.invalidation import invalidate_dicts
+
+        signal_calls = []
+
+        def set_signal(signal=None, **kwargs):
+            signal_calls.append(kwargs)
+
+        cache_invalidated.connect(set_signal, dispatch_uid=1, weak=False)
+        try:
+            invalidate_dicts(Category, [{'id': 1, 'title': 'a'}, {'title': 'a', 'id': 1}])
+        finally:
+            cache_invalidated.disconnect(dispatch_uid=1)
+        self.assertEqual(len(signal_calls), 1)
+
+    def test_bulk_create(self):
+        with self._script_calls() as load_script:
+            Category.objects.bulk_create([Category(title=str(i)) for i in range(10)])
+        self.assertEqual(load_script.call_count, 1)
+
+    def test_m2m_add(self):
+        brand = Brand.objects.create()
+        labels = [Label.objects.create() for _ in range(3)]
+        with self._script_calls() as load_script:
+            brand.labels.add(*labels)
+        # One for m2m_changed and one for through objects being bulk created
+        self.assertEqual(load_script.call_count, 2)
+
+    def test_m2m_clear(self):
+        brand = Brand.objects.create()
+        brand.labels.add(*[Label.objects.create() for _ in range(3)])
+        list(brand.labels.cache())
+
+        with self._script_calls() as load_script:
+            brand.labels.clear()
+        self.assertEqual(load_script.call_count, 1)
+        with self.assertNumQueries(1):
+            self.assertEqual(list(brand.labels.cache()), [])
+
+    def test_delete_cascade(self):
+        category = Category.objects.create(title='a')
+        for i in range(10):
+            Post.objects.create(title=str(i), category=category)
+        list(Post.objects.cache().filter(title='1'))
+
+        with self._script_calls() as load_script:
+            category.delete()
+        # A call per table
+        self.assertEqual(load_script.call_count, 2)
+        with self.assertNumQueries(1):
+            list(Post.objects.cache().filter(title='1'))
+
+    def test_delete_queryset(self):
+        for i in range(10):
+            Category.objects.create(title=str(i))
+
+        with self._script_calls() as load_script:
+            Category.objects.filter(title__in=['1', '2', '3']).delete()
+        self.assertEqual(load_script.call_count, 1)
+
+    def test_save(self):
+        c = Category.objects.create(title='a')
+        list(Category.objects.cache().filter(title='a'))
+
+        c.title = 'b'
+        with self._script_calls() as load_script:
+            c.save()
+        # Old and new states go together
+        self.assertEqual(load_script.call_count, 1)
+        with self.assertNumQueries(1):
+            list(Category.objects.cache().filter(title='a'))
+
+
+class ModelInvalidationTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def _conj_keys(self):
+        from cacheops.sharding import get_prefix
+
+        prefix = get_prefix(tables=[Post._meta.db_table], dbs=['default'])
+        return redis_client.smembers('%sconjs:%s' % (prefix, Post._meta.db_table))
+
+    def test_registry(self):
+        list(Post.objects.cache().filter(pk=1))
+        list(Post.objects.cache().filter(category=1))
+        self.assertEqual(len(self._conj_keys()), 2)
+
+        invalidate_obj(Post.objects.get(pk=1))
+        self.assertEqual(self._conj_keys(), set())
+
+    def test_invalidate_model(self):
+        list(Post.objects.cache().filter(pk=1))
+        list(Post.objects.cache().filter(category=1))
+
+        with mock.patch('cacheops.invalidation.INVALIDATE_CHUNK', 1), \
+                mock.patch.object(redis_client, 'keys') as keys:
+            invalidate_model(Post)
+        self.assertEqual(keys.call_count, 0)
+        self.assertEqual(self._conj_keys(), set())
+
+        with self.assertNumQueries(2):
+            list(Post.objects.cache().filter(pk=1))
+            list(Post.objects.cache().filter(category=1))
+
+    @override_settings(CACHEOPS_COMPACT_KEYS=False)
+    def test_prune_expired(self):
+        from cacheops.invalidation import invalidate_conds
+
+        list(Post.objects.cache().filter(visible=True))
+        list(Post.objects.cache().filter(category=1))
+        [expired] = [key for key in self._conj_keys() if b'category_id' in key]
+        redis_client.delete(expired)
+
+        # Looks up conj keys with any visible walking registry, doesn't match expired one
+        invalidate_conds(Post, [{'category_id': 2}])
+        self.assertEqual(self._conj_keys(), set())
+
+
+@override_settings(CACHEOPS_INVALIDATE_BUDGET=2)
+class InvalidateBudgetTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def _cache_querysets(self):
+        qss = [
+            Category.objects.cache().filter(title='Django'),
+            Category.objects.cache().filter(title='Django').order_by('pk'),
+            Category.objects.cache().filter(title='Django').values_list('pk'),
+        ]
+        for qs in qss:
+            list(qs)
+        return qss
+
+    def test_big_conj_key(self):
+        from cacheops.sharding import get_prefix
+
+        qss = self._cache_querysets()
+        with mock.patch('cacheops.invalidation.INVALIDATE_CHUNK', 2), \
+                mock.patch('cacheops.invalidation._invalidate_conj_members',
+                           wraps=invalidation._invalidate_conj_members) as chunked:
+            invalidate_obj(Category.objects.get(title='Django'))
+        self.assertEqual(chunked.call_count, 1)
+
+        prefix = get_prefix(tables=[Category._meta.db_table], dbs=['default'])
+        conjs_key = '%sconjs:%s' % (prefix, Category._meta.db_table)
+        self.assertEqual(redis_client.smembers(conjs_key), set())
+        with self.assertNumQueries(len(qss)):
+            for qs in qss:
+                list(qs.all())
+
+    def test_within_budget(self):
+        list(Category.objects.cache().filter(title='Django'))
+        with mock.patch('cacheops.invalidation._invalidate_conj_members') as chunked:
+            invalidate_obj(Category.objects.get(title='Django'))
+        self.assertEqual(chunked.call_count, 0)
+
+        with self.assertNumQueries(1):
+            list(Category.objects.cache().filter(title='Django'))
+
+    def test_changed_fields(self):
+        qss = [Post.objects.cache().filter(category=1).values_list(field)
+               for field in ('title', 'visible', 'pk')]
+        for qs in qss:
+            list(qs)
+
+        post = Post.objects.get(pk=1)
+        post.visible = not post.visible
+        with mock.patch('cacheops.invalidation._invalidate_conj_members',
+                        wraps=invalidation._invalidate_conj_members) as chunked:
+            post.save()
+        self.assertEqual(chunked.call_count, 1)
+
+        # Only the one depending on visible is invalidated
+        with self.assertNumQueries(1):
+            for qs in qss:
+                list(qs.all())
+
+
+# Schemes are checked by field names here, not ids
+@override_settings(CACHEOPS_COMPACT_KEYS=False)
+class SchemesTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def _schemes(self):
+        from cacheops.sharding import get_prefix
+
+        prefix = get_prefix(tables=[Post._meta.db_table], dbs=['default'])
+        return redis_client.smembers('%sschemes:%s' % (prefix, Post._meta.db_table))
+
+    def test_reap(self):
+        from cacheops.invalidation import reap_schemes
+
+        list(Post.objects.cache().filter(title='Cacheops'))
+        list(Post.objects.cache().filter(category=3, visible=True))
+        self.assertEqual(len(self._schemes()), 2)
+
+        invalidate_obj(Post.objects.get(title='Cacheops'))
+        self.assertEqual(reap_schemes(Post), [b'title'])
+        self.assertEqual(len(self._schemes()), 1)
+
+        # Still invalidated by the live one
+        invalidate_obj(Post.objects.get(pk=2))
+        with self.assertNumQueries(1):
+            list(Post.objects.cache().filter(category=3, visible=True))
+
+    def test_used_while_reaping(self):
+        from cacheops import invalidation
+
+        list(Post.objects.cache().filter(title='Cacheops'))
+        list(Post.objects.cache().filter(category=3))
+        invalidate_obj(Post.objects.get(title='Cacheops'))
+
+        # Cache a query using the scheme after reaping started
+        load_script = invalidation.load_script
+
+        def prune_and_cache(*args, **kwargs):
+            list(Post.objects.cache().filter(title='Cacheops'))
+            return load_script('prune_conjs')(*args, **kwargs)
+
+        with mock.patch('cacheops.invalidation.load_script',
+                        side_effect=lambda name: prune_and_cache if name == 'prune_conjs'
+                                                 else load_script(name)):
+            self.assertEqual(invalidation.reap_schemes(Post), [])
+        self.assertEqual(self._schemes(), {b'title', b'category_id'})
+
+    def test_reap_unregistered(self):
+        from cacheops.invalidation import reap_schemes
+        from cacheops.sharding import get_prefix
+
+        # Imitate cache written by a version predating conj keys registry
+        qs = Post.objects.cache().filter(title='Cacheops')
+        list(qs)
+        redis_client.flushdb()
+        prefix = get_prefix(tables=[Post._meta.db_table], dbs=['default'])
+        redis_client.set(qs._cache_key(), b'stale')
+        redis_client.sadd('%sconj:%s:title=Cacheops' % (prefix, Post._meta.db_table),
+                          qs._cache_key())
+        redis_client.sadd('%sschemes:%s' % (prefix, Post._meta.db_table), 'title')
+
+        self.assertEqual(reap_schemes(Post), [])
+        invalidate_obj(Post.objects.get(title='Cacheops'))
+        self.assertFalse(redis_client.exists(qs._cache_key()))
+
+    def test_canonical_order(self):
+        list(Post.objects.cache().filter(visible=True, title='Cacheops', category=1))
+        list(Post.objects.cache().filter(category=1, title='Cacheops', visible=True))
+        self.assertEqual(self._schemes(), {b'category_id,title,visible'})
+
+    def test_merge(self):
+        from cacheops.invalidation import merge_schemes
+        from cacheops.sharding import get_prefix
+
+        qs = Post.objects.cache().filter(category=1, visible=True)
+        list(qs)
+        # Imitate cache written by an older version
+        prefix = get_prefix(tables=[Post._meta.db_table], dbs=['default'])
+        conj_key = '%sconj:%s:visible=True&category_id=1' % (prefix, Post._meta.db_table)
+        redis_client.sadd(conj_key, qs._cache_key())
+        redis_client.sadd('%sconjs:%s' % (prefix, Post._meta.db_table), conj_key)
+        redis_client.sadd('%sschemes:%s' % (prefix, Post._meta.db_table), 'visible,category_id')
+
+        self.assertEqual(merge_schemes(Post), [b'visible,category_id'])
+        self.assertEqual(self._schemes(), {b'category_id,visible'})
+        self.assertFalse(redis_client.exists(conj_key))
+        with self.assertNumQueries(1):
+            list(qs.all())
+
+    def test_merge_unregistered(self):
+        from cacheops.invalidation import merge_schemes
+        from cacheops.sharding import get_prefix
+
+        # Imitate cache written by a version predating conj keys registry
+        qs = Post.objects.cache().filter(category=1, visible=True)
+        list(qs)
+        redis_client.flushdb()
+        prefix = get_prefix(tables=[Post._meta.db_table], dbs=['default'])
+        conj_key = '%sconj:%s:visible=True&category_id=1' % (prefix, Post._meta.db_table)
+        redis_client.set(qs._cache_key(), b'stale')
+        redis_client.sadd(conj_key, qs._cache_key())
+        redis_client.sadd('%sschemes:%s' % (prefix, Post._meta.db_table), 'visible,category_id')
+
+        self.assertEqual(merge_schemes(Post), [b'visible,category_id'])
+        self.assertFalse(redis_client.exists(conj_key))
+        self.assertFalse(redis_client.exists(qs._cache_key()))
+
+    def test_command(self):
+        from django.core.management import call_command
+
+        list(Post.objects.cache().filter(title='Cacheops'))
+        invalidate_obj(Post.objects.get(title='Cacheops'))
+        call_command('reapschemes', 'tests.Post')
+        self.assertEqual(self._schemes(), set())
+
+
+@override_settings(CACHEOPS_COMPACT_KEYS=True)
+class CompactKeysTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def test_cache_key(self):
+        self.assertEqual(len(Post.objects.filter(pk=1)._cache_key(prefix=False)), 2 + 22)
+
+    def test_conj_keys(self):
+        list(Post.objects.cache().filter(category=1, visible=True))
+        keys = redis_client.keys('*')
+        self.assertFalse(any(b'conj:' in key for key in keys))
+        conj_keys = [key for key in keys if re.search(br'(^|:)j:', key)]
+        self.assertEqual(len(conj_keys), 1)
+        self.assertNotIn(Post._meta.db_table.encode(), conj_keys[0])
+        self.assertNotIn(b'category_id', conj_keys[0])
+
+    def test_invalidate(self):
+        qs = Post.objects.cache().filter(category=1, visible=True)
+        list(qs)
+        invalidate_obj(Post.objects.get(pk=1))
+        with self.assertNumQueries(1):
+            list(qs.all())
+
+        # Other category is not affected
+        invalidate_obj(Post.objects.get(pk=2))
+        with self.assertNumQueries(0):
+            list(qs.all())
+
+    def test_changed_fields(self):
+        qs = Post.objects.cache().values('title').filter(category=1)
+        list(qs)
+        post = Post.objects.get(pk=1)
+        post.visible = not post.visible
+        post.save()
+        with self.assertNumQueries(0):
+            list(qs.all())
+
+        post.title = 'changed'
+        post.save()
+        with self.assertNumQueries(1):
+            list(qs.all())
+
+    def test_reap(self):
+        from cacheops.invalidation import reap_schemes
+
+        list(Post.objects.cache().filter(title='Cacheops'))
+        list(Post.objects.cache().filter(category=3))
+        invalidate_obj(Post.objects.get(pk=1))
+        self.assertEqual(len(reap_schemes(Post)), 1)
+
+        # The live one still works
+        invalidate_obj(Post.objects.get(pk=2))
+        with self.assertNumQueries(1):
+            list(Post.objects.cache().filter(category=3))
+
+
+@override_settings(CACHEOPS_GENERATIONS=True)
+class GenerationsTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def test_invalidate_model(self):
+        list(Post.objects.cache().filter(pk=1))
+
+        with mock.patch('cacheops.invalidation.load_script') as script_calls:
+            invalidate_model(Post)
+        self.assertEqual(script_calls.call_count, 0)
+
+        with self.assertNumQueries(1):
+            list(Post.objects.cache().filter(pk=1))
+        with self.assertNumQueries(0):
+            list(Post.objects.cache().filter(pk=1))
+
+    def test_joined(self):
+        list(Post.objects.cache().filter(category__title='Django'))
+        invalidate_model(Category)
+
+        with self.assertNumQueries(1):
+            list(Post.objects.cache().filter(category__title='Django'))
+
+    def test_other_model(self):
+        list(Post.objects.cache().filter(pk=1))
+        invalidate_model(Category)
+
+        with self.assertNumQueries(0):
+            list(Post.objects.cache().filter(pk=1))
+
+    def test_invalidate_obj(self):
+        post = Post.objects.cache().get(pk=1)
+        invalidate_obj(post)
+
+        with self.assertNumQueries(1):
+            Post.objects.cache().get(pk=1)
+
+    def test_cached_as(self):
+        get_calls = make_inc(cached_as(Post))
+
+        self.assertEqual(get_calls(), 1)
+        self.assertEqual(get_calls(), 1)
+        invalidate_model(Post)
+        self.assertEqual(get_calls(), 2)
+
+    def test_fetch_many(self):
+        fetch_many(Post.objects.cache().filter(category=1), Category.objects.cache().all())
+        invalidate_model(Category)
+
+        with self.assertNumQueries(1):
+            fetch_many(Post.objects.cache().filter(category=1), Category.objects.cache().all())
+
+
+@override_settings(CACHEOPS_SNAPSHOT=True)
+class SnapshotTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def test_save(self):
+        post = Post.objects.get(pk=1)
+        list(Post.objects.cache().filter(category=1))
+
+        post.category_id = 2
+        with self.assertNumQueries(1):
+            post.save()
+        with self.assertNumQueries(1):
+            list(Post.objects.cache().filter(category=1))
+
+    def test_save_twice(self):
+        post = Post.objects.get(pk=1)
+        post.category_id = 2
+        post.save()
+        list(Post.objects.cache().filter(category=2))
+
+        post.category_id = 3
+        with self.assertNumQueries(1):
+            post.save()
+        with self.assertNumQueries(1):
+            list(Post.objects.cache().filter(category=2))
+
+    def test_from_cache(self):
+        post = Post.objects.cache().get(pk=1)
+        post.title = 'New'
+        with self.assertNumQueries(1):
+            post.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(Post.objects.cache().get(pk=1).title, 'New')
+
+    def test_deferred(self):
+        post = Post.objects.only('title').get(pk=1)
+        self.assertNotIn('cacheops_snapshot', post._state.__dict__)
+
+    def test_update_fields(self):
+        post = Post.objects.get(pk=1)
+        post.title = 'Not saved'
+        post.save(update_fields=['visible'])
+        self.assertNotIn('cacheops_snapshot', post._state.__dict__)
+
+    def test_refresh_from_db(self):
+        post = Post.objects.get(pk=1)
+        post.refresh_from_db()
+        with self.assertNumQueries(2):
+            post.save()
+
+    def test_pickle(self):
+        data = pickle.dumps(Post.objects.get(pk=1), -1)
+        self.assertNotIn(b'cacheops_snapshot', data)
+
+        post = pickle.loads(data)
+        post.category_id = 2
+        with self.assertNumQueries(1):
+            post.save()
+
+    def test_pickle_changed(self):
+        post = Post.objects.get(pk=1)
+        post.category_id = 2
+        post = pickle.loads(pickle.dumps(post, -1))
+        list(Post.objects.cache().filter(category=1))
+
+        with self.assertNumQueries(1):
+            post.save()
+        with self.assertNumQueries(1):
+            list(Post.objects.cache().filter(category=1))
+
+    def test_pickle_deferred(self):
+        post = pickle.loads(pickle.dumps(Post.objects.only('title').get(pk=1), -1))
+        self.assertNotIn('cacheops_snapshot', post._state.__dict__)
+
+    def test_pickle_update_fields(self):
+        post = Post.objects.get(pk=1)
+        post.title = 'Not saved'
+        post.save(update_fields=['visible'])
+        post = pickle.loads(pickle.dumps(post, -1))
+        self.assertNotIn('cacheops_snapshot', post._state.__dict__)
+
+
+class IgnoreFieldsTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def setUp(self):
+        super(IgnoreFieldsTests, self).setUp()
+        patcher = mock.patch.dict(model_profile(Post), ignore_fields=('visible', 'category'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_ignored(self):
+        post = Post.objects.cache().get(pk=1)
+        post.visible = not post.visible
+        post.category_id = 2
+        post.save()
+
+        with self.assertNumQueries(0):
+            Post.objects.cache().get(pk=1)
+
+    def test_not_ignored(self):
+        post = Post.objects.cache().get(pk=1)
+        post.visible = not post.visible
+        post.title = 'New'
+        post.save()
+
+        with self.assertNumQueries(1):
+            self.assertEqual(Post.objects.cache().get(pk=1).title, 'New')
+
+    def test_update_fields(self):
+        post = Post.objects.cache().get(pk=1)
+        post.visible = not post.visible
+        # No need to fetch old state
+        with self.assertNumQueries(1):
+            post.save(update_fields=['visible'])
+
+        with self.assertNumQueries(0):
+            Post.objects.cache().get(pk=1)
+
+        with self.assertNumQueries(2):
+            post.save(update_fields=['visible', 'title'])
+
+
+class DependentFieldsTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def test_dependent_fields(self):
+        from cacheops.tree import dependent_fields
+
+        self.assertEqual(dependent_fields(Post.objects.values('title').filter(category=1)),
+                         {'title', 'category_id'})
+        self.assertEqual(dependent_fields(Post.objects.only('title').order_by('-visible')),
+                         {'id', 'title', 'visible'})
+        self.assertEqual(dependent_fields(Post.objects.defer('title').filter(pk=1)),
+                         {'id', 'category_id', 'visible'})
+        self.assertIsNone(dependent_fields(Post.objects.all()))
+        self.assertIsNone(dependent_fields(Post.objects.values('title')
+                                                       .filter(category__title='Django')))
+        categories = Category.objects.all()
+        self.assertIsNone(dependent_fields(Post.objects.values('title')
+                                                       .filter(category__in=categories)))
+
+    def test_unaffected(self):
+        post = Post.objects.get(pk=1)
+        list(Post.objects.cache().values('title').filter(category=1))
+
+        post.visible = not post.visible
+        post.save()
+        with self.assertNumQueries(0):
+            list(Post.objects.cache().values('title').filter(category=1))
+
+    def test_selected(self):
+        post = Post.objects.get(pk=1)
+        list(Post.objects.cache().only('title').filter(category=1))
+
+        post.title = 'New'
+        post.save()
+        with self.assertNumQueries(1):
+            list(Post.objects.cache().only('title').filter(category=1))
+
+    def test_filtered(self):
+        post = Post.objects.get(pk=1)
+        list(Post.objects.cache().values('title').filter(visible=True))
+
+        post.visible = not post.visible
+        post.save()
+        with self.assertNumQueries(1):
+            list(Post.objects.cache().values('title').filter(visible=True))
+
+    def test_ordered(self):
+        post = Post.objects.get(pk=1)
+        list(Post.objects.cache().values('title').filter(category=1).order_by('visible'))
+
+        post.visible = not post.visible
+        post.save()
+        with self.assertNumQueries(1):
+            list(Post.objects.cache().values('title').filter(category=1).order_by('visible'))
+
+    def test_all_fields(self):
+        post = Post.objects.get(pk=1)
+        list(Post.objects.cache().filter(category=1))
+
+        post.visible = not post.visible
+        post.save()
+        with self.assertNumQueries(1):
+            list(Post.objects.cache().filter(category=1))
+
+    def test_invalidate_obj(self):
+        list(Post.objects.cache().values('title').filter(category=1))
+        invalidate_obj(Post.objects.get(pk=1))
+
+        with self.assertNumQueries(1):
+            list(Post.objects.cache().values('title').filter(category=1))
+
+    def test_survives_in_conj(self):
+        post = Post.objects.get(pk=1)
+        list(Post.objects.cache().values('title').filter(category=1))
+        post.visible = not post.visible
+        post.save()
+
+        # Still invalidated later
+        post.title = 'New'
+        post.save()
+        with self.assertNumQueries(1):
+            list(Post.objects.cache().values('title').filter(category=1))
+
+    def test_invalidate_model(self):
+        list(Post.objects.cache().values('title').filter(category=1))
+        invalidate_model(Post)
+
+        with self.assertNumQueries(1):
+            list(Post.objects.cache().values('title').filter(category=1))
+
+    @override_settings(CACHEOPS_PREFIX=lambda q: 'my app:')
+    def test_prefix_with_space(self):
+        def cache_both():
+            list(Post.objects.cache().values('title').filter(category=1))
+            list(Post.objects.cache().filter(category=1))
+
+        cache_both()
+        invalidate_obj(Post.objects.get(pk=1))
+        with self.assertNumQueries(2):
+            cache_both()
+
+        invalidate_model(Post)
+        with self.assertNumQueries(2):
+            cache_both()
+
+        with override_settings(CACHEOPS_INVALIDATE_BUDGET=1):
+            invalidate_obj(Post.objects.get(pk=1))
+        with self.assertNumQueries(2):
+            cache_both()
+
+
+class UpdateInvalidationTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def setUp(self):
+        super(UpdateInvalidationTests, self).setUp()
+        patcher = mock.patch.dict(model_profile(Post), invalidate_updates=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_update(self):
+        list(Post.objects.cache().filter(category=1))
+        list(Post.objects.cache().filter(category=2))
+        list(Post.objects.cache().filter(category=3))
+        list(Post.objects.cache().filter(pk=1))
+
+        with self.assertNumQueries(1):
+            Post.objects.filter(category=1).update(category=2)
+
+        with self.assertNumQueries(3):
+            list(Post.objects.cache().filter(category=1))
+            list(Post.objects.cache().filter(category=2))
+            # Any pk may match
+            list(Post.objects.cache().filter(pk=1))
+        with self.assertNumQueries(0):
+            list(Post.objects.cache().filter(category=3))
+
+    def test_invalidated_update(self):
+        list(Post.objects.cache().filter(category=1))
+
+        with self.assertNumQueries(1):
+            Post.objects.filter(category=1).invalidated_update(category=2)
+        with self.assertNumQueries(1):
+            list(Post.objects.cache().filter(category=1))
+
+    def test_expression(self):
+        from django.db.models import F
+
+        list(Post.objects.cache().filter(category=3))
+        Post.objects.filter(pk=1).update(category=F('category'))
+
+        # Don't know what category we set
+        with self.assertNumQueries(1):
+            list(Post.objects.cache().filter(category=3))
+
+    def test_no_conditions(self):
+        list(Post.objects.cache().filter(category=3))
+
+        with mock.patch('cacheops.invalidation.invalidate_model') as invalidate_model:
+            Post.objects.update(visible=True)
+        invalidate_model.assert_called_once_with(Post, using='default')
+
+    def test_unaffected_fields(self):
+        list(Post.objects.cache().values('title').filter(category=1))
+        Post.objects.filter(category=1).update(visible=False)
+
+        with self.assertNumQueries(0):
+            list(Post.objects.cache().values('title').filter(category=1))
+
+    def test_pattern_escaping(self):
+        from cacheops.invalidation import invalidate_conds
+
+        list(Post.objects.cache().filter(title='a*', category=1))
+        list(Post.objects.cache().filter(title='ab', category=1))
+        invalidate_conds(Post, [{'title': 'a*'}])
+
+        with self.assertNumQueries(1):
+            list(Post.objects.cache().filter(title='a*', category=1))
+        with self.assertNumQueries(0):
+            list(Post.objects.cache().filter(title='ab', category=1))
+
+    def test_disabled(self):
+        list(Post.objects.cache().filter(category=1))
+        with mock.patch.dict(model_profile(Post), invalidate_updates=False):
+            Post.objects.filter(category=1).update(category=2)
+
+        with self.assertNumQueries(0):
+            list(Post.objects.cache().filter(category=1))
+
+
 class NoInvalidationTests(BaseTestCase):
     fixtures = ['basic']
 
@@ -151,6 +953,79 @@ class NoInvalidationTests(BaseTestCase):
         self._template(invalidate)
 
 
+class PostponeInvalidationTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def test_context_manager(self):
+        post = Post.objects.cache().get(pk=1)
+        with postpone_invalidation:
+            invalidate_obj(post)
+            with self.assertNumQueries(0):
+                Post.objects.cache().get(pk=1)
+
+        with self.assertNumQueries(1):
+            Post.objects.cache().get(pk=1)
+
+    def test_decorator(self):
+        post = Post.objects.cache().get(pk=1)
+        postpone_invalidation(invalidate_obj)(post)
+
+        with self.assertNumQueries(1):
+            Post.objects.cache().get(pk=1)
+
+    def test_batched(self):
+        from cacheops.redis import load_script
+
+        post = Post.objects.get(pk=1)
+        with mock.patch('cacheops.invalidation.load_script', wraps=load_script) as script_calls:
+            with postpone_invalidation:
+                for _ in range(3):
+                    post.save()
+                with postpone_invalidation:
+                    Category.objects.get(pk=1).save()
+        # A single call per model, both old and new states of post are same
+        self.assertEqual(script_calls.call_count, 2)
+
+    def test_dedup(self):
+        signal_calls = []
+
+        def set_signal(signal=None, **kwargs):
+            signal_calls.append(kwargs)
+
+        post = Post.objects.get(pk=1)
+        cache_invalidated.connect(set_signal, dispatch_uid=1, weak=False)
+        try:
+            with postpone_invalidation:
+                invalidate_obj(post)
+                invalidate_obj(post)
+        finally:
+            cache_invalidated.disconnect(dispatch_uid=1)
+        self.assertEqual(len(signal_calls), 1)
+
+    def test_model(self):
+        from cacheops.redis import load_script
+
+        post = Post.objects.cache().get(pk=1)
+        with mock.patch('cacheops.invalidation.load_script', wraps=load_script) as script_calls:
+            with postpone_invalidation:
+                invalidate_obj(post)
+                invalidate_model(Post)
+        # Only model is invalidated
+        script_calls.assert_called_once_with('invalidate_conjs', strip=mock.ANY)
+
+        with self.assertNumQueries(1):
+            Post.objects.cache().get(pk=1)
+
+    def test_no_invalidation(self):
+        post = Post.objects.cache().get(pk=1)
+        with postpone_invalidation:
+            with no_invalidation:
+                invalidate_obj(post)
+
+        with self.assertNumQueries(0):
+            Post.objects.cache().get(pk=1)
+
+
 class LocalGetTests(BaseTestCase):
     def setUp(self):
         Local.objects.create(pk=1)
@@ -159,6 +1034,259 @@ class LocalGetTests(BaseTestCase):
     def test_unhashable_args(self):
         Local.objects.cache().get(pk__in=[1, 2])
 
+    def test_invalidation(self):
+        Local.objects.cache().get(pk=1)
+        Local.objects.filter(pk=1).update(tag=5)
+        with self.assertNumQueries(0):
+            self.assertEqual(Local.objects.cache().get(pk=1).tag, None)
+
+        Local.objects.get(pk=1).save()
+        with self.assertNumQueries(1):
+            self.assertEqual(Local.objects.cache().get(pk=1).tag, 5)
+
+    def test_invalidation_from_other_process(self):
+        from cacheops.local import local_get_cache, LOCAL_GET_CHANNEL
+
+        Local.objects.cache().get(pk=1)
+        self.assertEqual(len(local_get_cache), 1)
+
+        redis_client.publish(LOCAL_GET_CHANNEL, Local._meta.db_table)
+        for _ in range(100):
+            if not len(local_get_cache):
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(local_get_cache), 0)
+
+    def test_subscribed_on_set(self):
+        from cacheops.local import LocalGetCache, LOCAL_GET_CHANNEL
+
+        def subscribers():
+            return dict(redis_client.pubsub_numsub(LOCAL_GET_CHANNEL))[LOCAL_GET_CHANNEL.encode()]
+
+        count = subscribers()
+        cache = LocalGetCache(10)
+        cache.set(1, 1, 'table', 60)
+        self.assertEqual(subscribers(), count + 1)
+
+        # Published right after set(), still not missed
+        redis_client.publish(LOCAL_GET_CHANNEL, 'table')
+        for _ in range(100):
+            if not len(cache):
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(cache), 0)
+
+    def test_reconnect(self):
+        from redis import ConnectionError
+        from cacheops.local import LocalGetCache
+
+        cache = LocalGetCache(10)
+        pubsub = mock.Mock(get_message=mock.Mock(side_effect=ConnectionError))
+        with mock.patch.object(cache, '_subscribe', side_effect=SystemExit), \
+                mock.patch('time.sleep'):
+            self.assertRaises(SystemExit, cache._listen, pubsub)
+        pubsub.close.assert_called_once_with()
+
+    def test_timeout(self):
+        from cacheops.local import local_get_cache
+
+        with mock.patch('cacheops.local.local_get_cache.set', wraps=local_get_cache.set) as set_:
+            Local.objects.cache().get(pk=1)
+            Local.objects.cache().get(pk=1)
+            self.assertEqual(set_.call_count, 1)
+            with mock.patch('time.time', return_value=time.time() + 60*60 + 1):
+                Local.objects.cache().get(pk=1)
+            self.assertEqual(set_.call_count, 2)
+
+    def test_size(self):
+        from cacheops.local import LocalGetCache
+
+        cache = LocalGetCache(2)
+        for key in range(3):
+            cache.set(key, key, 'table', 60)
+        self.assertEqual(len(cache), 2)
+        self.assertRaises(CacheMiss, cache.lookup, 0)
+        self.assertEqual(cache.lookup(2), 2)
+
+
+class LocalCacheTests(BaseTestCase):
+    def setUp(self):
+        super(LocalCacheTests, self).setUp()
+        LocalCached.objects.create(tag=1)
+
+    def test_queryset(self):
+        # First call caches to redis, second one loads into local cache
+        from cacheops.local import _get_if_changed
+
+        list(LocalCached.objects.cache())
+        list(LocalCached.objects.cache())
+        results = []
+
+        def get_if_changed(*args):
+            results.append(_get_if_changed(*args))
+            return results[-1]
+
+        with mock.patch('cacheops.local._get_if_changed', side_effect=get_if_changed):
+            with self.assertNumQueries(0):
+                self.assertEqual(len(LocalCached.objects.cache()), 1)
+                self.assertEqual(len(LocalCached.objects.cache()), 1)
+        # Data is not transferred, only a version check is made
+        self.assertEqual(results, [1, 1])
+
+    def test_mutation(self):
+        LocalCached.objects.cache().get(tag=1)
+        obj = LocalCached.objects.cache().get(tag=1)
+        obj.tag = 2
+        self.assertEqual(LocalCached.objects.cache().get(tag=1).tag, 1)
+
+    def test_queryset_invalidation(self):
+        list(LocalCached.objects.cache())
+        list(LocalCached.objects.cache())
+        LocalCached.objects.create(tag=2)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(len(LocalCached.objects.cache()), 2)
+
+    def test_cached_as(self):
+        get_calls = make_inc(cached_as(Category, local_cache=True))
+
+        self.assertEqual(get_calls(), 1)
+        self.assertEqual(get_calls(), 1)
+        Category.objects.create(title='test')
+        self.assertEqual(get_calls(), 2)
+
+    def test_cached_as_window(self):
+        get_calls = make_inc(cached_as(Category, local_cache=60))
+
+        self.assertEqual(get_calls(), 1)
+        self.assertEqual(get_calls(), 1)
+        Category.objects.create(title='test')
+        # Stale value is still served within window
+        self.assertEqual(get_calls(), 1)
+
+
+class StaleTests(BaseTestCase):
+    def _expire(self):
+        # Emulate cache keys expiring, stale copies outlive them for a while
+        for key in redis_client.keys('*:stale'):
+            redis_client.delete(key[:-len(':stale')])
+            redis_client.expire(key, 30)
+
+    def _lock_refresh(self):
+        for key in redis_client.keys('*:stale'):
+            redis_client.set(key + b':lock', 'LOCK')
+
+    def test_expired(self):
+        get_calls = make_inc(cached_as(Category, stale=60))
+
+        self.assertEqual(get_calls(), 1)
+        self._expire()
+        # We are the first to see it expired, so we refresh it
+        self.assertEqual(get_calls(), 2)
+        self.assertEqual(get_calls(), 2)
+
+    def test_serve_stale_while_refreshing(self):
+        get_calls = make_inc(cached_as(Category, stale=60))
+
+        self.assertEqual(get_calls(), 1)
+        self._expire()
+        self._lock_refresh()
+        self.assertEqual(get_calls(), 1)
+
+    def test_invalidation(self):
+        get_calls = make_inc(cached_as(Category, stale=60))
+
+        self.assertEqual(get_calls(), 1)
+        self._lock_refresh()
+        Category.objects.create(title='test')
+        self.assertEqual(get_calls(), 2)
+
+    def test_invalidation_near_expiry(self):
+        get_calls = make_inc(cached_as(Category, stale=60))
+
+        for n, invalidate in enumerate([lambda: Category.objects.create(title='test'),
+                                        lambda: invalidate_model(Category)], 1):
+            self.assertEqual(get_calls(), n)
+            self._lock_refresh()
+            invalidate()
+            # Stale copy TTL falls to stale as cache key approaches its expiration
+            for key in redis_client.keys('*:stale'):
+                redis_client.expire(key, 30)
+            self.assertEqual(get_calls(), n + 1)
+
+    def test_stale_on_invalidation(self):
+        get_calls = make_inc(cached_as(Category, stale=60, stale_on_invalidation=True))
+
+        self.assertEqual(get_calls(), 1)
+        self._lock_refresh()
+        Category.objects.create(title='test')
+        self.assertEqual(get_calls(), 1)
+
+    def test_lock(self):
+        get_calls = make_inc(cached_as(Category, lock=True, stale=60))
+
+        self.assertEqual(get_calls(), 1)
+        self._expire()
+        # Another worker is calculating it meanwhile
+        for key in redis_client.keys('*:stale'):
+            redis_client.set(key[:-len(':stale')], 'LOCK')
+        self.assertEqual(get_calls(), 1)
+
+    def test_queryset(self):
+        with mock.patch.dict(model_profile(Category), stale=60):
+            list(Category.objects.cache())
+            with no_invalidation:
+                Category.objects.create(title='test')
+            self._expire()
+            self._lock_refresh()
+            with self.assertNumQueries(0):
+                self.assertEqual(len(Category.objects.cache()), 0)
+
+
+class EarlyExpirationTests(BaseTestCase):
+    def test_expires_early(self):
+        from cacheops.serializers import stamp_expiry, expires_early
+
+        data = stamp_expiry(b'data', 10, 5)
+        with mock.patch('random.random', return_value=0):
+            self.assertFalse(expires_early(data, 1))
+        with mock.patch('random.random', return_value=0.99):
+            self.assertTrue(expires_early(data, 1))
+            self.assertFalse(expires_early(data, 0.01))
+        self.assertFalse(expires_early(b'data', 1))
+
+    def test_cached_as(self):
+        get_calls = make_inc(cached_as(Category, early=True))
+
+        self.assertEqual(get_calls(), 1)
+        with mock.patch('cacheops.query.expires_early', return_value=True):
+            self.assertEqual(get_calls(), 2)
+        self.assertEqual(get_calls(), 2)
+
+    def test_queryset(self):
+        list(Category.objects.cache())
+        with mock.patch.dict(model_profile(Category), early=1.0), \
+                mock.patch('cacheops.query.expires_early', return_value=True):
+            with self.assertNumQueries(1):
+                list(Category.objects.cache())
+
+    def test_cached(self):
+        from cacheops import cached
+
+        get_calls = make_inc(cached(timeout=60, early=True))
+        self.assertEqual(get_calls(), 1)
+        with mock.patch('cacheops.simple.expires_early', return_value=True):
+            self.assertEqual(get_calls(), 2)
+        self.assertEqual(get_calls(), 2)
+
+    def test_jitter(self):
+        get_calls = make_inc(cached_as(Category, timeout=100, jitter=0.5))
+
+        with mock.patch('random.random', return_value=0.5):
+            get_calls()
+        [key] = redis_client.keys('*as:*')
+        self.assertEqual(redis_client.ttl(key), 75)
+
 
 class DbAgnosticTests(BaseTestCase):
     databases = ('default', 'slave')
@@ -179,3 +1307,168 @@ class DbAgnosticTests(BaseTestCase):
 
         with self.assertNumQueries(1, using='slave'):
             list(DbBinded.objects.cache().using('slave'))
+
+
+class FetchManyTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def test_fetch_many(self):
+        posts, categories = fetch_many(Post.objects.cache().filter(category=1),
+                                       Category.objects.cache().all())
+        self.assertEqual(posts, list(Post.objects.nocache().filter(category=1)))
+        self.assertEqual(categories, list(Category.objects.nocache().all()))
+
+        with self.assertNumQueries(0):
+            fetch_many(Post.objects.cache().filter(category=1), Category.objects.cache().all())
+
+    def test_partial_miss(self):
+        list(Category.objects.cache().all())
+
+        with self.assertNumQueries(1):
+            fetch_many(Post.objects.cache().filter(category=1), Category.objects.cache().all())
+
+    def test_invalidation(self):
+        fetch_many(Post.objects.cache().filter(category=1), Category.objects.cache().all())
+        Category.objects.create(title='New')
+
+        with self.assertNumQueries(1):
+            _, categories = fetch_many(Post.objects.cache().filter(category=1),
+                                       Category.objects.cache().all())
+            self.assertEqual(categories[-1].title, 'New')
+
+    def test_nocache(self):
+        with self.assertNumQueries(2):
+            fetch_many(Category.objects.nocache(), Category.objects.nocache())
+
+    def test_stale(self):
+        with mock.patch.dict(model_profile(Category), stale=60):
+            fetch_many(Category.objects.cache())
+            # Expire it and let someone else refresh it, see StaleTests
+            for key in redis_client.keys('*:stale'):
+                redis_client.delete(key[:-len(':stale')])
+                redis_client.expire(key, 30)
+                redis_client.set(key + b':lock', 'LOCK')
+
+            with self.assertNumQueries(0):
+                fetch_many(Category.objects.cache())
+
+
+class CompactSerializerTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def setUp(self):
+        from cacheops.serializers import CompactSerializer
+        super(CompactSerializerTests, self).setUp()
+        self.serializer = CompactSerializer()
+
+    def _round_trip(self, data):
+        return self.serializer.loads(self.serializer.dumps(data))
+
+    def test_models(self):
+        posts = list(Post.objects.all())
+        loaded = self._round_trip(posts)
+        self.assertEqual(loaded, posts)
+        self.assertEqual([p.__dict__.keys() for p in loaded], [p.__dict__.keys() for p in posts])
+        self.assertFalse(loaded[0]._state.adding)
+        self.assertEqual(loaded[0]._state.db, 'default')
+        self.assertEqual(self.serializer.pack(posts)[0], 'm')
+
+    def test_deferred(self):
+        posts = list(Post.objects.only('title'))
+        loaded = self._round_trip(posts)
+        self.assertEqual([p.title for p in loaded], [p.title for p in posts])
+        self.assertEqual(loaded[0].get_deferred_fields(), posts[0].get_deferred_fields())
+
+    def test_deferred_class(self):
+        # Imitate Django 1.8/1.9 deferred class
+        posts = list(Post.objects.all())
+        with mock.patch.object(Post, '_deferred', True, create=True):
+            self.assertEqual(self.serializer.pack(posts)[0], 'p')
+
+    def test_fallback(self):
+        from django.db.models import Value, IntegerField
+        posts = list(Post.objects.annotate(one=Value(1, IntegerField())))
+        self.assertEqual(self.serializer.pack(posts)[0], 'p')
+        self.assertEqual(self._round_trip(posts)[0].one, 1)
+
+        posts = list(Post.objects.select_related('category'))
+        self.assertEqual(self.serializer.pack(posts)[0], 'p')
+        self.assertEqual(self._round_trip(posts)[0].category.title, posts[0].category.title)
+
+    def test_values(self):
+        values = list(Post.objects.values('id', 'title'))
+        self.assertEqual(self._round_trip(values), values)
+
+        values_list = list(Post.objects.values_list('id', 'title'))
+        self.assertEqual(self._round_trip(values_list), values_list)
+
+    def test_cached_as(self):
+        @cached_as(Post, serializer='compact')
+        def get_posts():
+            return list(Post.objects.all())
+
+        posts = get_posts()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_posts(), posts)
+
+    def test_custom_serializer(self):
+        # Data starting with bytes used for headers, e.g. from msgpack
+        class ByteSerializer(object):
+            def dumps(self, data):
+                return bytes(bytearray([data]))
+
+            def loads(self, data):
+                return bytearray(data)[0]
+
+        for n in range(4):
+            get_n = cached_as(Post, extra=n, serializer=ByteSerializer())(lambda: n)
+            self.assertEqual(get_n(), n)
+            self.assertEqual(get_n(), n)
+
+
+class CompressionTests(BaseTestCase):
+    def setUp(self):
+        super(CompressionTests, self).setUp()
+
+        def set_signal(signal=None, **kwargs):
+            self.signal_calls.append(kwargs)
+
+        self.signal_calls = []
+        cache_compressed.connect(set_signal, dispatch_uid=1, weak=False)
+
+    def tearDown(self):
+        super(CompressionTests, self).tearDown()
+        cache_compressed.disconnect(dispatch_uid=1)
+
+    def test_cached_as(self):
+        @cached_as(Category, compress=True)
+        def get_data():
+            calls.append(1)
+            return 'x' * 10000
+
+        calls = []
+        self.assertEqual(get_data(), 'x' * 10000)
+        self.assertEqual(get_data(), 'x' * 10000)
+        self.assertEqual(len(calls), 1)
+
+        [stats] = self.signal_calls
+        self.assertGreater(stats['raw_size'], 10000)
+        self.assertLess(stats['stored_size'], 1000)
+
+    def test_min_size(self):
+        get_calls = make_inc(cached_as(Category, compress=True))
+        self.assertEqual(get_calls(), 1)
+        self.assertEqual(get_calls(), 1)
+        [stats] = self.signal_calls
+        self.assertEqual(stats['raw_size'], stats['stored_size'])
+
+    def test_simple_cache(self):
+        from cacheops import cache
+
+        with override_settings(CACHEOPS_COMPRESS=True):
+            cache.set('key', 'x' * 10000)
+        self.assertLess(len(redis_client.get('key')), 1000)
+        self.assertEqual(cache.get('key'), 'x' * 10000)
+
+        cache.set('key', 'y' * 10000)
+        self.assertEqual(cache.get('key'), 'y' * 10000)
@@ -50,6 +50,25 @@ class BasicTests(BaseTestCase):
         with self.assertNumQueries(0):
             list(Category.objects.filter(pk__exact=1).cache())
 
+    def test_get_by_pk_or_id(self):
+        Category.objects.cache().get(pk=1)
+        with self.assertNumQueries(0):
+            Category.objects.cache().get(id=1)
+            Category.objects.cache().get(id__exact='1')
+            list(Category.objects.cache().filter(pk=1).order_by('title'))
+
+    def test_get_by_unique_field(self):
+        Extra.objects.cache().get(tag=5)
+        with self.assertNumQueries(0):
+            Extra.objects.cache().get(tag__exact=5)
+        with self.assertNumQueries(1):
+            list(Extra.objects.cache().filter(tag=5).values('tag'))
+
+    def test_get_by_pk_sliced(self):
+        list(Category.objects.cache().filter(pk=1))
+        with self.assertNumQueries(1):
+            self.assertEqual(list(Category.objects.cache().filter(pk=1)[1:]), [])
+
     def test_exists(self):
         with self.assertNumQueries(1):
             Category.objects.cache(ops='exists').exists()
@@ -975,14 +994,14 @@ class MultiDBInvalidationTests(BaseTestCase):
         with self._control_counts():
             Category.objects.using('slave').invalidated_update(title='update')
 
-    @mock.patch('cacheops.invalidation.invalidate_dict')
-    def test_m2m_changed_call_invalidate(self, mock_invalidate_dict):
+    @mock.patch('cacheops.query.invalidate_dicts')
+    def test_m2m_changed_call_invalidate(self, mock_invalidate_dicts):
         label = Label.objects.create()
         brand = Brand.objects.create()
         brand.labels.add(label)
-        mock_invalidate_dict.assert_called_with(mock.ANY, mock.ANY, using=DEFAULT_DB_ALIAS)
+        mock_invalidate_dicts.assert_called_with(mock.ANY, mock.ANY, using=DEFAULT_DB_ALIAS)
 
         label = Label.objects.using('slave').create()
         brand = Brand.objects.using('slave').create()
         brand.labels.add(label)
-        mock_invalidate_dict.assert_called_with(mock.ANY, mock.ANY, using='slave')
+        mock_invalidate_dicts.assert_called_with(mock.ANY, mock.ANY, using='slave')
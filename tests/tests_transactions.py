@@ -5,9 +5,10 @@ from django.db import connection
 from django.db.transaction import atomic
 from django.test import TransactionTestCase
 
+from cacheops import postpone_invalidation
 from cacheops.transaction import queue_when_in_transaction
 
-from .models import Category
+from .models import Category, Post
 from .utils import run_in_thread
 
 
@@ -33,6 +34,41 @@ class TransactionSupportTests(TransactionTestCase):
         self.assertEqual('Changed', run_in_thread(get_category).title)
         self.assertEqual('Changed', get_category().title)
 
+    def test_postpone_invalidation(self):
+        with postpone_invalidation:
+            with atomic():
+                obj = get_category()
+                obj.title = 'Changed'
+                obj.save()
+            # Committed, but not invalidated yet
+            self.assertEqual('Django', run_in_thread(get_category).title)
+        self.assertEqual('Changed', run_in_thread(get_category).title)
+
+        with atomic():
+            with postpone_invalidation:
+                obj.title = 'Changed again'
+                obj.save()
+            # Invalidation is flushed, but waits for commit
+            self.assertEqual('Changed', run_in_thread(get_category).title)
+        self.assertEqual('Changed again', run_in_thread(get_category).title)
+
+    def test_delete_cascade(self):
+        from cacheops.transaction import transaction_states
+
+        with atomic():
+            category = Category.objects.create(title='New')
+            for i in range(10):
+                Post.objects.create(title=str(i), category=category)
+            list(Post.objects.cache().filter(category=category))
+
+            queued = len(transaction_states['default'][-1]['cbs'])
+            category_pk = category.pk
+            category.delete()
+            # Queued a single invalidation per table
+            self.assertEqual(len(transaction_states['default'][-1]['cbs']), queued + 2)
+        self.assertEqual(
+            run_in_thread(lambda: list(Post.objects.cache().filter(category=category_pk))), [])
+
     def test_nested(self):
         with atomic():
             with atomic():